@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Per-operation cost of model attribute access: reading a field, writing a
+field and hydrating a full row fetched from the database.
+
+Usage: python benchmarks/bench_attributes.py [iterations]
+"""
+import sys
+import uuid
+import timeit
+
+from telephus.cassandra.ttypes import Column, ColumnOrSuperColumn
+from polydorus import RowModel
+from polydorus.attributes import *
+
+class BenchModel(RowModel):
+    class Meta:
+        column_family = 'bench'
+
+    id = UUIDAttribute(row_key=True)
+    first_name = StringAttribute(indexed=True)
+    last_name = StringAttribute(indexed=True)
+    email = StringAttribute()
+    int_test = IntegerAttribute()
+    long_test = LongAttribute()
+    bool_test = BooleanAttribute(default=True)
+    other_id = UUIDAttribute()
+    counter_a = LongAttribute()
+    counter_b = LongAttribute()
+    counter_c = LongAttribute()
+    note_a = StringAttribute()
+    note_b = StringAttribute()
+    note_c = StringAttribute()
+    code = IntegerAttribute()
+
+def make_row():
+    o = BenchModel(first_name=u'Jane', last_name=u'Schmidt', email=u'jane@example.com', int_test=7, long_test=7L,
+                   other_id=uuid.uuid1(), counter_a=1L, counter_b=2L, counter_c=3L,
+                   note_a=u'a', note_b=u'b', note_c=u'c', code=4)
+    key = uuid.uuid1()
+    columns = [ColumnOrSuperColumn(column=Column(name=k, value=o._attributes[k].to_db_value(getattr(o, k)), timestamp=0))
+               for k in BenchModel._attributes if k != 'id']
+    return key, columns
+
+def run(iterations):
+    key, columns = make_row()
+    o = BenchModel._result_to_instance(key, columns)
+
+    def read():
+        o.first_name
+
+    def write():
+        o.int_test = 5
+
+    def hydrate():
+        BenchModel._result_to_instance(key, columns)
+
+    print '%-22s %12s' % ('operation', 'ns')
+    for name, f, n in (('field read', read, iterations), ('field write', write, iterations), ('hydrate %d columns' % len(columns), hydrate, iterations / 10)):
+        print '%-22s %12.0f' % (name, min(timeit.repeat(f, number=n, repeat=3)) / n * 1e9)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
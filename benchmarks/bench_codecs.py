@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Per-column cost of encoding and decoding values: the utils.pack/utils.unpack
+dispatch versus the codecs each attribute resolves at class creation.
+
+Usage: python benchmarks/bench_codecs.py [iterations]
+"""
+import sys
+import decimal
+import timeit
+
+from polydorus import utils
+from polydorus.attributes import *
+
+columns = [
+    ('LongAttribute', LongAttribute(), 1234567890123L),
+    ('IntegerAttribute', IntegerAttribute(), 12345),
+    ('StringAttribute', StringAttribute(), u'Вильямс'),
+    ('UUIDAttribute', UUIDAttribute(), uuid.uuid1()),
+    ('DecimalAttribute', DecimalAttribute(16, 10), decimal.Decimal('3.1415992961')),
+]
+
+def legacy_scale(attribute):
+    return decimal.Decimal(long(math.pow(10, attribute.decimal_places)))
+
+def run(iterations):
+    print '%-18s %12s %12s %12s %12s' % ('column', 'pack ns', 'encode ns', 'unpack ns', 'decode ns')
+    for name, attribute, value in columns:
+        db_value = attribute._coerce_to_db(value)
+        data_type = attribute._db_type
+        attribute._compile()
+        encode, decode = attribute._encode, attribute._decode
+        packed = encode(db_value)
+        assert packed == utils.pack(db_value, data_type)
+
+        if isinstance(attribute, DecimalAttribute):
+            # Before: the scale was rebuilt with math.pow for every value
+            old_pack = lambda: utils.pack(long(value * legacy_scale(attribute)), data_type)
+            new_pack = lambda: encode(long(value * attribute._scale))
+            old_unpack = lambda: decimal.Decimal(utils.unpack(packed, data_type)) / legacy_scale(attribute)
+            new_unpack = lambda: decimal.Decimal(decode(packed)) / attribute._scale
+        else:
+            old_pack = lambda: utils.pack(db_value, data_type)
+            new_pack = lambda: encode(db_value)
+            old_unpack = lambda: utils.unpack(packed, data_type)
+            new_unpack = lambda: decode(packed)
+
+        timings = [min(timeit.repeat(f, number=iterations, repeat=3)) / iterations * 1e9 for f in (old_pack, new_pack, old_unpack, new_unpack)]
+        print '%-18s %12.0f %12.0f %12.0f %12.0f' % ((name,) + tuple(timings))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Rows per second written by save() one instance at a time versus
+save_many(), against a local stand-in client that acknowledges every
+batch_mutate after a fixed delay (the round trip).
+
+Usage: python benchmarks/bench_save_many.py [rows] [round trip ms]
+"""
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import inlineCallbacks
+from polydorus import RowModel
+from polydorus.attributes import *
+from polydorus.configuration import Configuration
+
+class BenchModel(RowModel):
+    class Meta:
+        column_family = 'bench'
+
+    id = UUIDAttribute(row_key=True)
+    first_name = StringAttribute(indexed=True)
+    last_name = StringAttribute(indexed=True)
+    email = StringAttribute()
+    int_test = IntegerAttribute()
+    long_test = LongAttribute()
+
+class StandInClient(object):
+    """Counts the batch_mutate calls and rows it receives and answers each one after delay seconds."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.rows = 0
+
+    def batch_mutate(self, mutation_map, consistency=None):
+        self.calls += 1
+        self.rows += len(mutation_map)
+        return task.deferLater(reactor, self.delay, lambda: None)
+
+def make_rows(n):
+    return [BenchModel(first_name=u'Jane', last_name=u'Schmidt', email=u'jane@example.com', int_test=i, long_test=long(i)) for i in xrange(n)]
+
+@inlineCallbacks
+def run(rows, delay):
+    client = Configuration.cassandra_client = StandInClient(delay)
+
+    print '%-12s %10s %10s %12s' % ('method', 'rows', 'calls', 'rows/s')
+    instances = make_rows(rows / 10)
+    start = time.time()
+    for o in instances:
+        yield o.save()
+    print '%-12s %10d %10d %12.0f' % ('save', len(instances), client.calls, len(instances) / (time.time() - start))
+
+    client.calls = 0
+    instances = make_rows(rows)
+    start = time.time()
+    results = yield BenchModel.save_many(instances)
+    assert all(r is True for r in results)
+    print '%-12s %10d %10d %12.0f' % ('save_many', len(instances), client.calls, len(instances) / (time.time() - start))
+
+def main(rows, delay):
+    d = run(rows, delay)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001)
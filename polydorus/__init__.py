@@ -1,4 +1,6 @@
 from base_model import BaseModel, BaseModelMeta
 from row_model import RowModel, RowModelMeta
 from column_model import ColumnModel, ColumnModelMeta
+from session import Session
+from write_behind import WriteBehindBuffer, write_behind_buffer
 from attributes import *
\ No newline at end of file
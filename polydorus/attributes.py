@@ -18,7 +18,7 @@ from dateutil import parser
 from operator import attrgetter, itemgetter
 from types import *
 import utils
-from query import Query
+from query import Query, AnyOf
 import json
 
 IndexOperator.NE = -1
@@ -34,6 +34,13 @@ class GenericAttribute(object):
     _type = str
     _db_type = str
     _model_class = None
+    _encode = None
+    _decode = None
+
+    @property
+    def _sort_ordered(self):
+        """True when _sort_format encodings order values the way Python compares them."""
+        return self._db_type in (int, long, unicode)
     
     def __init__(self, *args, **kwargs):
         self.__dict__.update(kwargs)
@@ -55,6 +62,17 @@ class GenericAttribute(object):
     
     def __ne__(self, other):
         return IndexExpression(self.name, IndexOperator.NE, self.validate(other))
+
+    def in_(self, values):
+        """Returns an AnyOf matching rows whose value is one of values."""
+        packed = []
+        for v in values:
+            v = self._db_format(v)
+            if v not in packed:
+                packed.append(v)
+        any_of = AnyOf(*[IndexExpression(self.name, IndexOperator.EQ, v) for v in packed])
+        any_of.disjoint = True
+        return any_of
     
     def _coerce(self, value):
         return self._type(value)
@@ -73,15 +91,50 @@ class GenericAttribute(object):
         else:
             return self._db_type(value) 
         
+    def _compile(self):
+        """Resolves the attribute's encoder/decoder pair once; called by BaseModelMeta."""
+        self._encode, self._decode = utils.codec_for(self._db_type)
+
     def _pack(self, value):
-        return None if value is None else utils.pack(value, self._db_type)
+        if value is None:
+            return None
+        elif self._encode is not None:
+            return self._encode(value)
+        return utils.pack(value, self._db_type)
 
     def _unpack(self, value):
+        if self._decode is not None:
+            return self._decode(value)
         return utils.unpack(value, self._db_type)
 
     def _db_format(self, value):
         return self._pack(self._coerce_to_db(self._coerce(value)))
 
+    def _sort_format(self, packed):
+        """
+        Encodes a packed db value so that comparing the encoded bytes orders
+        values the way Python orders them, None first. Used for the column
+        names of sort index rows.
+        """
+        if packed is None:
+            return '\x00'
+        elif self._db_type in (int, long):
+            return '\x01' + chr(ord(packed[0]) ^ 0x80) + packed[1:]
+        else:
+            return '\x01' + packed.replace('\x00', '\x00\xff') + '\x00\x00'
+
+    def _sort_parse(self, encoded):
+        """Returns the packed db value that _sort_format encoded; raises ValueError for anything else."""
+        if encoded == '\x00':
+            return None
+        elif encoded[:1] != '\x01':
+            raise ValueError('Not a sort encoded value')
+        elif self._db_type in (int, long):
+            return chr(ord(encoded[1]) ^ 0x80) + encoded[2:]
+        elif not encoded.endswith('\x00\x00'):
+            raise ValueError('Not a sort encoded value')
+        return encoded[1:-2].replace('\x00\xff', '\x00')
+
     # Filter input when properties are set
     def input_filter(self, model, value): return value
     
@@ -121,7 +174,8 @@ class UUIDAttribute(GenericAttribute):
         return uuid.UUID(value) if isinstance(value, str) else value
 
     def _coerce_to_db(self, value):
-        return None if value is None else value.bytes
+        # Same bytes as value.bytes, which builds them one byte at a time
+        return None if value is None else ('%032x' % value.int).decode('hex')
         
     def _coerce_from_db(self, value):
         return uuid.UUID(bytes=value)
@@ -193,16 +247,19 @@ class DecimalAttribute(GenericAttribute):
         super(DecimalAttribute, self).__init__(self, *args, **kwargs)
         self.max_digits = max_digits
         self.decimal_places = decimal_places
+        self._scale = decimal.Decimal(10) ** decimal_places
                     
     def _coerce_from_db(self, value):
-        return decimal.Decimal(value) / decimal.Decimal(long(math.pow(10, self.decimal_places)))
+        return decimal.Decimal(value) / self._scale
         
     def _coerce_to_db(self, value):
-        return None if value is None else `long(value * decimal.Decimal(long(math.pow(10, self.decimal_places))))`
+        return None if value is None else long(value * self._scale)
         
 class JSONAttribute(GenericAttribute):
     _type = None
     _db_type = unicode
+    # JSON text does not order like the values it encodes
+    _sort_ordered = False
     
     def validate(self, value):
         return value
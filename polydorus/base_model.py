@@ -1,5 +1,6 @@
 from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
 from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
 import uuid
 import logging
 import datetime
@@ -13,12 +14,121 @@ from netaddr.ip import IPAddress
 from netaddr.strategy import ipv4
 from dateutil import parser
 from operator import attrgetter, itemgetter
+from functools import partial
 from attributes import *
 from configuration import Configuration
 from query import Query, QueryResult
+from utils import merge_mutation_maps
+from write_behind import write_behind_buffer
+
+def _call_in_order(calls):
+    """
+    Calls each of calls (no-argument callables) in order and returns what the
+    last one returns. Once one of them returns a Deferred, the rest are
+    chained onto it and a Deferred is returned instead, so hooks that finish
+    synchronously cost no Deferreds.
+    """
+    result = None
+    for i, f in enumerate(calls):
+        result = f()
+        if isinstance(result, defer.Deferred):
+            rest = calls[i + 1:]
+            if rest:
+                result.addCallback(lambda _: _call_in_order(rest))
+            return result
+    return result
+
+def _call_each(f, items):
+    """
+    Calls f(item) for each of items and returns a Deferred firing with a
+    (success, result) pair for each, like a DeferredList with consumeErrors,
+    only waiting on the calls that returned a Deferred.
+    """
+    outcomes = []
+    pending = []
+    for item in items:
+        try:
+            result = f(item)
+        except Exception:
+            outcomes.append((False, Failure()))
+            continue
+        if isinstance(result, defer.Deferred):
+            pending.append((len(outcomes), result))
+            outcomes.append(None)
+        else:
+            outcomes.append((True, result))
+    if not pending:
+        return defer.succeed(outcomes)
+
+    def settled(results):
+        for (i, d), outcome in zip(pending, results):
+            outcomes[i] = outcome
+        return outcomes
+    return defer.DeferredList([d for i, d in pending], consumeErrors=True).addCallback(settled)
+
+def _overrides(attribute, hook):
+    """True when attribute's hook is not the no-op GenericAttribute one, set either by a subclass or as a keyword argument."""
+    return hook in attribute.__dict__ or getattr(type(attribute), hook).im_func is not getattr(GenericAttribute, hook).im_func
+
+class AttributeDescriptor(object):
+    """
+    Data descriptor installed on a model class for each of its attributes.
+    Reads and writes go straight to the instance's slot storage; on the class
+    itself it returns the GenericAttribute so query expressions still work.
+    """
+    __slots__ = ('attribute', 'name', 'index', 'bit', 'filtered')
+
+    def __init__(self, attribute, index):
+        self.attribute = attribute
+        self.name = attribute.name
+        self.index = index
+        self.bit = 1 << index
+        # filter_input only has work to do for these attributes
+        self.filtered = bool(attribute.read_only or attribute.write_once or attribute.required
+            or _overrides(attribute, 'input_filter'))
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.attribute
+        if instance._undecoded & self.bit:
+            # Lazily hydrated column, decoded on first read
+            v = instance._values[self.index] = self.attribute.from_db_value(instance._values[self.index])
+            instance._undecoded &= ~self.bit
+            return v
+        return instance._values[self.index]
+
+    def __set__(self, instance, value):
+        self.set(instance, value)
+
+    def set(self, instance, value, filter=True):
+        v = self.attribute.validate(value)
+        if filter and self.filtered:
+            v = self.attribute.filter_input(instance, v)
+        instance._values[self.index] = v
+        instance._undecoded &= ~self.bit
+        instance._dirty |= self.bit
+
+    def load(self, instance, value, lazy=False):
+        """Trusted load of a packed value read from the database: no validation or input filters."""
+        saved = instance._saved
+        if saved is None:
+            saved = instance._saved = [None] * len(instance._values)
+        saved[self.index] = value
+        if lazy:
+            instance._values[self.index] = value
+            instance._undecoded |= self.bit
+        else:
+            instance._values[self.index] = self.attribute.from_db_value(value)
+            instance._undecoded &= ~self.bit
+        instance._fetched |= self.bit
 
 class BaseModelMeta(type):
     """Meta class to set the _attributes attribute on each class instance without bubbling up to the super class"""
+    def __new__(mcs, name, bases, attrs):
+        # Instance state lives in the slots declared by BaseModel, so models get no per-instance __dict__
+        attrs.setdefault('__slots__', ())
+        return super(BaseModelMeta, mcs).__new__(mcs, name, bases, attrs)
+
     def __init__(cls, name, bases, attrs):
         super(BaseModelMeta, cls).__init__(name, bases, attrs)
 
@@ -33,16 +143,30 @@ class BaseModelMeta(type):
             cls.Meta.comparator_type = 'UTF8Type'
         if getattr(cls.Meta, 'subcomparator_type', None) is None:
             cls.Meta.subcomparator_type = 'UTF8Type'
+        cls._lazy_hydration = getattr(cls.Meta, 'lazy_hydration', None)
+        cls._write_behind = getattr(cls.Meta, 'write_behind', None)
             
-        delete_attributes = []
         for k, v in attrs.items():
             if isinstance(v, GenericAttribute):
                 v.name = k
                 v._model_class = cls.__class__
+                v._compile()
                 cls._attributes[k] = v
-                delete_attributes.append(k)
-        for k in delete_attributes:
-            delattr(cls, k)
+
+        # Fixed layout: attribute i is stored at _values[i] and owns bit i of the flag masks.
+        # Every class gets its own descriptors since a subclass's layout can differ from its parent's.
+        cls._attribute_names = tuple(sorted(cls._attributes))
+        cls._attribute_index = dict((k, i) for i, k in enumerate(cls._attribute_names))
+        cls._descriptors = {}
+        for i, k in enumerate(cls._attribute_names):
+            cls._descriptors[k] = AttributeDescriptor(cls._attributes[k], i)
+            setattr(cls, k, cls._descriptors[k])
+
+        # Save plan: only the attributes whose hooks do something are called by save()
+        attributes = [cls._attributes[k] for k in cls._attribute_names]
+        cls._pre_save_hooks = tuple(a for a in attributes if _overrides(a, 'pre_save'))
+        cls._post_save_hooks = tuple(a for a in attributes if _overrides(a, 'post_save'))
+        cls._required_attributes = tuple(a.name for a in attributes if a.required)
     
     def __getattr__(cls, attr):
         if attr not in cls._attributes: 
@@ -52,67 +176,97 @@ class BaseModelMeta(type):
 class BaseModel(object):
     """This is the base model for twisted & cassandra"""
     __metaclass__ = BaseModelMeta
-
-    _attribute_values = {}
-    _dirty = set()
-    _fetched = set()
-    _is_new = True
-    _protected_attributes = set(['_attribute_values', '_is_new', '_dirty', '_fetched', 'Meta'])
+    # _saved holds the packed value of each attribute as last read from or
+    # written to the database (None until there is one); _saving holds the
+    # changed values of a save in progress.
+    __slots__ = ('_values', '_dirty', '_fetched', '_undecoded', '_is_new', '_saved', '_saving')
     
     
     def __init__(self, is_new=True, *args, **kwargs):
-        self._attribute_values = {}
+        self._values = [None] * len(self._attribute_names)
         self._is_new = is_new
-        self._fetched = set()
+        self._dirty = 0
+        self._fetched = 0
+        self._undecoded = 0
+        self._saved = None
+        self._saving = None
         
         if is_new:
-            self._dirty = set(kwargs.keys())
-            for k, v in self._attributes.items():
-                default = getattr(v, 'default', None)
-                self._attribute_values[k] = default
+            for i, k in enumerate(self._attribute_names):
+                default = getattr(self._attributes[k], 'default', None)
+                self._values[i] = default
                 if not default is None:
-                    self._dirty.add(k)
+                    self._dirty |= 1 << i
             for k, v in kwargs.items():
                 self._setattr(k, v)
-        else:
-            self._dirty = set()
             
     class Meta:
         """This is model (user space) metadata, not python metadata"""
         pass
     
     def _setattr(self, name, value, filter=True):
-        self.__setattr__(name, value, filter=filter)
-    
-    def __setattr__(self, name, value, filter=True):
-        if name in self._protected_attributes:
-            super(BaseModel, self).__setattr__(name, value)
-        else:
-            attr = self._attributes[name]
-            v = attr.validate(value)
-            if filter:
-                v = attr.filter_input(self, v)
-            self._attribute_values[name] = v
-            self._dirty.add(name)
-        
-        
-    def __getattr__(self, name):
-        if name not in self._attributes:
-            raise AttributeError('%s not a property of %s' % (name, type(self)))
-            
-        v = self._attribute_values[name] if name in self._attribute_values else None
-        return v
+        self._descriptors[name].set(self, value, filter)
         
     def _setattr_from_db(self, name, value):
-        attr = self._attributes[name]
-        self._attribute_values[name] = attr.from_db_value(value)
-        self._fetched.add(name)
+        lazy = self._lazy_hydration
+        if lazy is None:
+            lazy = Configuration.lazy_hydration
+        self._descriptors[name].load(self, value, lazy)
+
+    def _load_from_db(self, columns):
+        """Bulk, trusted hydration from a list of ColumnOrSuperColumns named by attribute."""
+        lazy = self._lazy_hydration
+        if lazy is None:
+            lazy = Configuration.lazy_hydration
+        descriptors = self._descriptors
+        for column in columns:
+            descriptors[column.column.name].load(self, column.column.value, lazy)
+
+    def _load_key(self, name, value):
+        """Trusted assignment of a key attribute while hydrating."""
+        descriptor = self._descriptors[name]
+        self._values[descriptor.index] = value
+        self._dirty |= descriptor.bit
+
+    def _db_value(self, name):
+        """Returns the packed value of an attribute, reusing the fetched bytes when it has not been decoded."""
+        i = self._attribute_index[name]
+        if self._undecoded >> i & 1:
+            return self._values[i]
+        return self._attributes[name].to_db_value(self._values[i])
+
+    def _is_dirty(self, name):
+        return bool(self._dirty >> self._attribute_index[name] & 1)
+
+    def _saved_value(self, name):
+        """Returns the packed value of an attribute as last read from or written to the database, or None."""
+        return None if self._saved is None else self._saved[self._attribute_index[name]]
+
+    def _changed_attributes(self):
+        """
+        Returns {name: packed value} for the dirty attributes whose packed
+        value differs from the one last read or written, and remembers them
+        for _post_save. Assigning an attribute its current value, or back to
+        the stored one, changes nothing.
+        """
+        saved, values, undecoded = self._saved, self._values, self._undecoded
+        changed = {}
+        dirty, i = self._dirty, 0
+        while dirty:
+            if dirty & 1:
+                k = self._attribute_names[i]
+                packed = values[i] if undecoded >> i & 1 else self._attributes[k].to_db_value(values[i])
+                if saved is None or saved[i] != packed:
+                    changed[k] = packed
+            dirty >>= 1
+            i += 1
+        self._saving = changed
+        return changed
 
     def _getattr_for_db(self, name):
         attr = self._attributes[name]
-        value = self._attribute_values[name]
-        if name in self._dirty:
-            return attr.to_db_value(value)
+        if self._is_dirty(name):
+            return attr.to_db_value(getattr(self, name))
         else:
             raise Exception("%s is not dirty." % name)
     
@@ -136,27 +290,129 @@ class BaseModel(object):
     def _mutation_map_for_save(self):
         raise NotImplementedError("_mutation_map_for_save must be implemented by the subclass.")
     
-    @inlineCallbacks    
     def save(self, configuration=Configuration):
-        for k, p in self._attributes.items():
-            yield defer.maybeDeferred(p.pre_save, self)
+        d = defer.maybeDeferred(self._prepare_save)
+        d.addCallback(self._write_save, configuration)
+        return d
 
-        yield defer.maybeDeferred(self._pre_save)
-        
-        for k, a in self._attributes.items():
-            if a.required and self._attribute_values[k] is None:
+    def _uses_write_behind(self, configuration):
+        """True when saves of the model are queued in the write-behind buffer."""
+        if self._write_behind is None:
+            return configuration.write_behind
+        return self._write_behind
+
+    def _write_save(self, mutation_map, configuration):
+        if self._uses_write_behind(configuration):
+            # Acknowledged once queued; the buffer writes it out later
+            if mutation_map:
+                write_behind_buffer(configuration).add(mutation_map, self._post_write())
+            result = self._complete_save()
+        elif mutation_map:
+            result = configuration.cassandra_client.batch_mutate(mutation_map)
+            result.addCallback(lambda _: self._complete_save())
+        else:
+            # Nothing to write when no column changed
+            result = self._complete_save()
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(lambda _: True)
+        return True
+
+    def _prepare_save(self):
+        """
+        Runs the pre_save hooks and required checks and returns the mutation
+        map that saves the instance, or a Deferred of it when a hook is asynchronous.
+        """
+        calls = [partial(p.pre_save, self) for p in self._pre_save_hooks]
+        calls.extend((self._pre_save, self._check_required, self._mutation_map_for_save))
+        return _call_in_order(calls)
+
+    def _check_required(self):
+        for k in self._required_attributes:
+            if getattr(self, k) is None:
                 raise Exception("%s is required." % k)
-        
-        mutation_map = self._mutation_map_for_save()
-        yield configuration.cassandra_client.batch_mutate(mutation_map)
-        
-        for k, p in self._attributes.items():
-            yield defer.maybeDeferred(p.post_save, self)
 
-        self._post_save()
-        returnValue(True)
+    def _complete_save(self):
+        """Runs the post_save hooks once the mutation map has been written; returns a Deferred when a hook is asynchronous."""
+        calls = [partial(p.post_save, self) for p in self._post_save_hooks]
+        calls.append(self._post_save)
+        return _call_in_order(calls)
+
+    @classmethod
+    @inlineCallbacks
+    def save_many(cls, instances, chunk_rows=None, concurrency=None, configuration=Configuration):
+        """
+        Saves instances with as few round trips as possible: their mutation
+        maps are merged into batch_mutate calls of at most chunk_rows row keys
+        each, concurrency of them in flight at a time.
+
+        Returns a list with, for each instance, True once it has been saved
+        or the Failure that stopped it. A failed batch_mutate fails every
+        instance of its chunk. An instance listed twice is saved once; a
+        second instance for the key of an earlier one fails.
+        """
+        chunk_rows = chunk_rows or configuration.save_chunk_rows
+        semaphore = defer.DeferredSemaphore(concurrency or configuration.save_concurrency)
+        instances = list(instances)
+        results = [None] * len(instances)
+
+        first = {}
+        for i, o in enumerate(instances):
+            first.setdefault(id(o), i)
+        unique = sorted(first.values())
+        prepared = yield _call_each(lambda i: instances[i]._prepare_save(), unique)
+        chunks = []
+        mutation_map, members = {}, []
+        identities = set()
+        for i, (success, result) in zip(unique, prepared):
+            if not success:
+                results[i] = result
+                continue
+            identity = (type(instances[i]), instances[i]._identity_key())
+            if identity in identities:
+                # Its columns and sort index entries would be written alongside the other's
+                results[i] = Failure(Exception('save_many got two instances of %s for %r.' % (identity[0].__name__, identity[1])))
+                continue
+            identities.add(identity)
+            new_rows = sum(1 for key in result if key not in mutation_map)
+            if members and len(mutation_map) + new_rows > chunk_rows:
+                chunks.append((mutation_map, members))
+                mutation_map, members = {}, []
+            if new_rows == len(result):
+                mutation_map.update(result)
+            else:
+                merge_mutation_maps(mutation_map, result)
+            members.append(i)
+        if members:
+            chunks.append((mutation_map, members))
+
+        @inlineCallbacks
+        def send(mutation_map, members):
+            try:
+                if mutation_map:
+                    yield semaphore.run(configuration.cassandra_client.batch_mutate, mutation_map)
+            except Exception:
+                failure = Failure()
+                for i in members:
+                    results[i] = failure
+                return
+            completed = yield _call_each(lambda i: instances[i]._complete_save(), members)
+            for i, (success, result) in zip(members, completed):
+                results[i] = True if success else result
+
+        yield defer.DeferredList([send(*chunk) for chunk in chunks])
+        returnValue([results[first[id(o)]] for o in instances])
         
+    def _post_write(self):
+        """Returns a function to call once a save queued by write-behind has been written, or None."""
+        return None
+
     def _post_save(self):
+        if self._saving:
+            if self._saved is None:
+                self._saved = [None] * len(self._values)
+            for k, packed in self._saving.items():
+                self._saved[self._attribute_index[k]] = packed
+        self._saving = None
         self._is_new = False
     
     
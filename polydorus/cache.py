@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Size-bounded least-recently-used cache with per-entry expiry.
+
+    None is a valid value and records a missing row; it is kept for
+    negative_ttl seconds instead of ttl (0 disables negative caching, None
+    means no expiry). hits, misses and evictions count lookups so the cache
+    can be sized.
+
+    version is bumped by every invalidation; a fill that started before an
+    invalidation passes the version it saw to set() and is dropped, so a
+    read racing a write cannot put the old row back.
+    """
+    def __init__(self, max_size, ttl=None, negative_ttl=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[0] is not None and entry[0] <= self._clock()):
+            self.misses += 1
+            return default
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, version=None):
+        if version is not None and version != self.version:
+            return
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl == 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (None if ttl is None else self._clock() + ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.version += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -4,8 +4,9 @@ import uuid
 import logging
 import datetime
 from pytz import utc
-from telephus.cassandra.ttypes import InvalidRequestException, CfDef, ColumnDef, IndexExpression, IndexOperator
+from telephus.cassandra.ttypes import InvalidRequestException, CfDef, ColumnDef, IndexExpression, IndexOperator, Column, Deletion, SlicePredicate, SliceRange
 import copy
+import struct
 import math
 import decimal
 import re
@@ -15,8 +16,70 @@ from dateutil import parser
 from operator import attrgetter, itemgetter
 from attributes import *
 from configuration import Configuration
-from query import Query, QueryResult
+from query import Query, QueryResult, AnyOf, ColumnSliceIterator, MergedSliceIterator
 from base_model import BaseModel, BaseModelMeta
+from write_behind import write_behind_buffer
+from utils import timestamp, _gather, UUID_EPOCH
+
+class _PackedLayout(object):
+    """
+    The value of the single column that stores a packed ColumnModel object:
+    the number of slots in the layout ('>H'), a bitmap of those that are not
+    None, then each of those values as its attribute packs it, int and long
+    at their fixed widths and the others after their length ('>I').
+
+    Slot n - 1 holds the attribute with column tag n, so a value keeps its
+    position when attributes are added. Values written with fewer slots read
+    back with the rest as None. The tag of a removed attribute must not be
+    reused while values still store it.
+    """
+    _widths = {int: 4, long: 8}
+
+    def __init__(self, slots):
+        """slots: the attribute of each slot, None for the tags no attribute has."""
+        self.names = [a.name if a is not None else None for a in slots]
+        self.widths = [self._widths.get(a._db_type) if a is not None else None for a in slots]
+        self._bitmap_size = (len(slots) + 7) // 8
+
+    def pack(self, values):
+        """Returns the column value for {name: packed value}."""
+        bitmap = 0
+        parts = []
+        for i, name in enumerate(self.names):
+            v = values.get(name) if name is not None else None
+            if v is None:
+                continue
+            bitmap |= 1 << i
+            if self.widths[i] is None:
+                parts.append(struct.pack('>I', len(v)))
+            parts.append(v)
+        header = struct.pack('>H', len(self.names)) + ''.join(chr(bitmap >> 8 * i & 0xff) for i in range(self._bitmap_size))
+        return header + ''.join(parts)
+
+    def unpack(self, data):
+        """Returns (name, packed value) for each attribute stored in a column value."""
+        count = struct.unpack('>H', data[:2])[0]
+        if count > len(self.names):
+            raise Exception('Packed column has %d slots, the layout only %d.' % (count, len(self.names)))
+        position = 2 + (count + 7) // 8
+        bitmap = sum(ord(c) << 8 * i for i, c in enumerate(data[2:position]))
+        values = []
+        for i in range(count):
+            if not bitmap >> i & 1:
+                continue
+            if self.names[i] is None:
+                raise Exception('Packed column has a value for column tag %d, which no attribute has.' % (i + 1))
+            width = self.widths[i]
+            if width is None:
+                width = struct.unpack('>I', data[position:position + 4])[0]
+                position += 4
+            values.append((self.names[i], data[position:position + width]))
+            position += width
+        return values
+
+
+_bucket_sizes = {'hour': 3600, 'day': 86400}
+
 
 class ColumnModelMeta(BaseModelMeta):
     def __init__(cls, name, bases, attrs):
@@ -37,6 +100,49 @@ class ColumnModelMeta(BaseModelMeta):
         if cls._column_key is None and cls.Meta.column_family:
             raise Exception('No row_key found for non-primitive model.')
 
+        # Attributes stored as columns, i.e. all but the keys
+        keys = [a[0] for a in (cls._row_key, cls._column_key) if a is not None]
+        cls._column_attributes = [k for k in cls._attributes if k not in keys]
+
+        # Meta.column_tags maps each attribute name to a number that replaces it in column names
+        tags = getattr(cls.Meta, 'column_tags', None)
+        cls._column_tags = cls._tag_names = None
+        if tags:
+            for k in cls._column_attributes:
+                if k not in tags:
+                    raise Exception('No column tag for attribute: %s' % k)
+            if len(set(tags.values())) != len(tags):
+                raise Exception('Column tags must be unique.')
+            for k, tag in tags.items():
+                if k not in cls._column_attributes: raise Exception('Unknown attribute: %s' % k)
+                # Below 0x2000 the first byte is a control character, so a tag never reads as an attribute name
+                if not 0 < tag < 0x2000: raise Exception('Column tags must be between 1 and 8191.')
+            cls._column_tags = dict((k, struct.pack('>H', tag)) for k, tag in tags.items())
+            cls._tag_names = dict((v, k) for k, v in cls._column_tags.items())
+
+        # Meta.pack_attributes stores each object in one column named by its column key,
+        # each attribute at the position of its column tag. Saving an object that was not
+        # read first reads the stored column, so the attributes it did not set are kept.
+        cls._layout = None
+        if getattr(cls.Meta, 'pack_attributes', False):
+            if not tags:
+                raise Exception('Meta.pack_attributes needs Meta.column_tags.')
+            slots = [None] * max(tags.values())
+            for k, tag in tags.items():
+                slots[tag - 1] = cls._attributes[k]
+            cls._layout = _PackedLayout(slots)
+        cls._columns_per_object = 1 if cls._layout is not None else len(cls._column_attributes)
+
+        # Meta.row_bucket ('hour', 'day' or a number of seconds) spreads each row over one
+        # row per time bucket of the time UUID column keys
+        bucket = getattr(cls.Meta, 'row_bucket', None)
+        cls._bucket_size = _bucket_sizes.get(bucket, bucket)
+        if cls._bucket_size is not None:
+            if not isinstance(cls._bucket_size, (int, long)) or cls._bucket_size <= 0:
+                raise Exception("Meta.row_bucket must be 'hour', 'day' or a number of seconds.")
+            if not isinstance(cls._column_key[1], UUIDAttribute):
+                raise Exception('Bucketed models need a time UUID column key.')
+
 
 class ColumnModel(BaseModel):
     __metaclass__ = ColumnModelMeta
@@ -48,36 +154,166 @@ class ColumnModel(BaseModel):
 
     @classmethod
     def _pack_column(cls, column_key, attribute):
-        return '%s%s' % (cls._column_key[1]._db_format(column_key), attribute)
+        return cls._column_name(cls._name_key(cls._column_key[1]._db_format(column_key)), attribute)
+
+    @classmethod
+    def _column_name(cls, name_key, attribute):
+        """Returns the column name of attribute for the object whose column names start with name_key."""
+        if cls._column_tags is not None:
+            return '%s%s' % (name_key, cls._column_tags[attribute])
+        return '%s%s' % (name_key, attribute)
+
+    @classmethod
+    def _name_key(cls, packed_key):
+        """
+        Returns the 16 bytes that start the column names of the object with
+        the packed column key packed_key. Bucketed models put the time fields
+        of the time UUID first, most significant first, so that column names
+        sort by time.
+        """
+        if cls._bucket_size is None:
+            return packed_key
+        return packed_key[6:8] + packed_key[4:6] + packed_key[0:4] + packed_key[8:]
+
+    @classmethod
+    def _key_from_name(cls, name_key):
+        """Returns the packed column key that _name_key turned into name_key."""
+        if cls._bucket_size is None:
+            return name_key
+        return name_key[4:8] + name_key[2:4] + name_key[0:2] + name_key[8:]
     
     @classmethod    
     def _unpack_column(cls, column):
-        id = uuid.UUID(bytes=column[0:16])
+        """Returns the column key and attribute name of a column name, written with or without column tags."""
+        id = uuid.UUID(bytes=cls._key_from_name(column[0:16]))
         attribute_name = column[16:]
+        if cls._tag_names is not None:
+            attribute_name = cls._tag_names.get(attribute_name, attribute_name)
         return (id, attribute_name)
     
+    @classmethod
+    def _bucket(cls, packed_column_key):
+        """Returns the start, in seconds since the epoch, of the time bucket of a packed time UUID column key."""
+        column_key = uuid.UUID(bytes=packed_column_key)
+        if column_key.version != 1:
+            raise Exception('Bucketed models need time UUID column keys (got %s).' % column_key)
+        seconds = (column_key.time - UUID_EPOCH) // 10000000
+        return seconds - seconds % cls._bucket_size
+
+    @classmethod
+    def _bucket_row_key(cls, row_key, bucket):
+        return row_key + struct.pack('>q', bucket)
+
+    @classmethod
+    def _storage_row_key(cls, row_key, packed_column_key):
+        """Returns the key of the Cassandra row that holds an object, from its packed row and column keys."""
+        if cls._bucket_size is None:
+            return row_key
+        return cls._bucket_row_key(row_key, cls._bucket(packed_column_key))
+
+    @classmethod
+    def _bucket_row_keys(cls, row_key, start, finish):
+        """Returns the keys of the bucket rows for the times from column name prefix start to finish."""
+        if start is None or finish is None:
+            raise Exception('Reading a bucketed model needs both a start and a finish column key.')
+        first, last = sorted((cls._bucket(cls._key_from_name(start)), cls._bucket(cls._key_from_name(finish))))
+        return [cls._bucket_row_key(row_key, b) for b in range(first, last + 1, cls._bucket_size)]
+
+    def _identity_key(self):
+        return (getattr(self, self._row_key[0]), getattr(self, self._column_key[0]))
+
+    def _pre_save(self):
+        if self._layout is not None and self._saved is None:
+            # The packed column is rewritten whole, so attributes this object never set
+            # or read would be erased; read them from the stored object first
+            unset = [k for k in self._column_attributes if not self._dirty >> self._attribute_index[k] & 1]
+            if unset:
+                return self._load_stored(unset)
+
+    @inlineCallbacks
+    def _load_stored(self, names, configuration=Configuration):
+        """Loads the attributes names, as stored in any format, into an object that was not read from the database."""
+        column_key = self._getattr_for_db(self._column_key[0])
+        row_key = self._storage_row_key(self._getattr_for_db(self._row_key[0]), column_key)
+        record = yield configuration.cassandra_client.get_slice(row_key, self.Meta.column_family, names=self._object_columns(self._name_key(column_key)))
+        if not record:
+            return
+        stored = self._result_to_instance(getattr(self, self._row_key[0]), getattr(self, self._column_key[0]), record)
+        self._saved = [None] * len(self._values)
+        for k in self._column_attributes:
+            i = self._attribute_index[k]
+            if not stored._fetched >> i & 1:
+                continue
+            if k in names:
+                self._values[i], self._saved[i] = stored._values[i], stored._saved[i]
+                # Old format values stay dirty, so that the save moves them to the packed column
+                for bits in ('_fetched', '_undecoded', '_dirty'):
+                    setattr(self, bits, getattr(self, bits) | getattr(stored, bits) & 1 << i)
+            elif stored._saved[i] is None:
+                # Set here, but stored in an old format column that the save deletes
+                self._fetched |= 1 << i
+
     def _mutation_map_for_save(self):
+        changed = self._changed_attributes()
+        column_key = self._getattr_for_db(self._column_key[0])
+        name_key = self._name_key(column_key)
         insert_dict = {}
-        for k in self._dirty:
-        #for k, p in self._attributes.items():
-            v = self._attribute_values[k]
-            if k not in (self._row_key[0], self._column_key[0]):
-                insert_dict[self._pack_column(getattr(self, self._column_key[0]), k)] = self._getattr_for_db(k)
+        if self._layout is not None:
+            # Any change rewrites the whole packed column
+            if [k for k in changed if k not in (self._row_key[0], self._column_key[0])]:
+                insert_dict[name_key] = self._layout.pack(dict((k, self._db_value(k)) for k in self._column_attributes))
+        else:
+            for k, v in changed.items():
+                if k not in (self._row_key[0], self._column_key[0]):
+                    insert_dict[self._column_name(name_key, k)] = v
         
-        row_key = self._getattr_for_db(self._row_key[0])
+        row_key = self._storage_row_key(self._getattr_for_db(self._row_key[0]), column_key)
         mutation_map = {}
-        mutation_map.update({row_key: {self.Meta.column_family: insert_dict}})
+        if insert_dict:
+            old_columns = self._old_format_columns(name_key, changed)
+            if old_columns:
+                # Attributes read from columns written before Meta.column_tags or
+                # Meta.pack_attributes was set move to the current format
+                ts = timestamp()
+                mutations = [Column(name=n, value=v, timestamp=ts) for n, v in insert_dict.items()]
+                mutations.append(Deletion(timestamp=ts, predicate=SlicePredicate(column_names=old_columns)))
+                insert_dict = mutations
+            mutation_map.update({row_key: {self.Meta.column_family: insert_dict}})
         return mutation_map
 
+    def _old_format_columns(self, name_key, changed):
+        """Returns the names of the columns in an older format still stored for the changed attributes."""
+        if self._column_tags is None and self._layout is None:
+            return []
+        names = []
+        for k in changed:
+            # Read from an old format column: fetched, but with no saved value
+            if k in self._column_attributes and self._fetched >> self._attribute_index[k] & 1 and self._saved_value(k) is None:
+                names.append(name_key + k)
+                if self._layout is not None:
+                    names.append(name_key + self._column_tags[k])
+        return names
+
+    @classmethod
+    def _object_columns(cls, name_key):
+        """Returns every column name the object whose column names start with name_key can be stored under, older formats included."""
+        names = [name_key + k for k in cls._column_attributes]
+        if cls._column_tags is not None:
+            names.extend(name_key + cls._column_tags[k] for k in cls._column_attributes)
+        if cls._layout is not None:
+            names.append(name_key)
+        return names
+
 
     @classmethod
     @inlineCallbacks
     def get(cls, row_key, column_key=None, configuration=Configuration):
         if column_key is not None:
             # Get a single column object
-            names = [cls._pack_column(column_key, x) for x,v in cls._attributes.items() if not x in (cls._row_key[0], cls._column_key[0])]
-                
-            record = yield configuration.cassandra_client.get_slice(row_key.bytes, cls.Meta.column_family, names=names)
+            packed_key = cls._column_key[1]._db_format(column_key)
+            names = cls._object_columns(cls._name_key(packed_key))
+            storage_key = cls._storage_row_key(cls._row_key[1]._db_format(row_key), packed_key)
+            record = yield configuration.cassandra_client.get_slice(storage_key, cls.Meta.column_family, names=names)
                 
             if record == []:
                 returnValue(None)
@@ -85,44 +321,136 @@ class ColumnModel(BaseModel):
             o._post_get()
             returnValue(o)
         else:
-            # Get all column objects for row
-            cols = yield configuration.cassandra_client.get_slice(row_key.bytes, cls.Meta.column_family)
-            os = cls._result_to_instances(row_key, cols)
-            for o in os:
-                o._post_get()
+            # Get all column objects for row, a page of get_slice at a time
+            os = yield cls.slice(row_key, configuration=configuration)
             returnValue(os)
 
 
+    def _mutation_map_for_delete(self):
+        column_key = self._getattr_for_db(self._column_key[0])
+        row_key = self._storage_row_key(self._getattr_for_db(self._row_key[0]), column_key)
+        names = self._object_columns(self._name_key(column_key))
+        return {row_key: {self.Meta.column_family: [Deletion(timestamp=timestamp(), predicate=SlicePredicate(column_names=names))]}}
+
     @inlineCallbacks
     def delete(self, configuration=Configuration):
-        pass
+        """Deletes the object's columns, in every format it may be stored in, with one batch_mutate."""
+        if self._uses_write_behind(configuration):
+            # A queued save is stamped when it is flushed, so it would outlive the delete
+            column_key = self._getattr_for_db(self._column_key[0])
+            row_key = self._storage_row_key(self._getattr_for_db(self._row_key[0]), column_key)
+            write_behind_buffer(configuration).discard(row_key, self.Meta.column_family, self._object_columns(self._name_key(column_key)))
+        yield configuration.cassandra_client.batch_mutate(self._mutation_map_for_delete())
+        self._saved = None
+        returnValue(True)
+
+    @classmethod
+    def _delete_range_rows(cls, row_key, start, finish):
+        """Returns (storage row key, whether the range covers the whole row) for each row the range touches."""
+        if cls._bucket_size is None:
+            return [(row_key, start is None and finish is None)]
+        keys = cls._bucket_row_keys(row_key, start, finish)
+        # The range covers the time buckets strictly between those of start and finish
+        return [(key, 0 < i < len(keys) - 1) for i, key in enumerate(keys)]
+
+    @classmethod
+    def _mutation_map_for_delete_range(cls, row_key, start, finish, edge_columns=None):
+        """
+        Returns the mutation map that deletes a range: a row Deletion for each
+        row it covers whole, and for the others a SliceRange Deletion or, given
+        edge_columns ({storage row key: column names}), a Deletion of those columns.
+        """
+        ts = timestamp()
+        cf = cls.Meta.column_family
+        start_name, finish_name = cls._slice_range(start, finish, False)
+        mutation_map = {}
+        for key, whole in cls._delete_range_rows(row_key, start, finish):
+            if whole:
+                predicate = None
+            elif edge_columns is None:
+                predicate = SlicePredicate(slice_range=SliceRange(start=start_name, finish=finish_name))
+            elif edge_columns[key]:
+                predicate = SlicePredicate(column_names=edge_columns[key])
+            else:
+                continue
+            mutation_map[key] = {cf: [Deletion(timestamp=ts, predicate=predicate)]}
+        return mutation_map
+
+    @classmethod
+    @inlineCallbacks
+    def _column_names(cls, key, start_name, finish_name, configuration=Configuration):
+        """Returns the names of the columns of storage row key from start_name to finish_name, a page of get_slice at a time."""
+        client = configuration.cassandra_client
+        count = configuration.column_page_size * cls._columns_per_object + 1
+        names = []
+        while True:
+            columns = yield client.get_slice(key, cls.Meta.column_family, start=start_name, finish=finish_name, count=count)
+            page = [c.column.name for c in columns]
+            if names and page and page[0] == names[-1]:
+                # Each page after the first starts with the last column of the one before
+                page = page[1:]
+            names.extend(page)
+            if len(columns) < count:
+                returnValue(names)
+            start_name = names[-1]
+
+    @classmethod
+    @inlineCallbacks
+    def delete_range(cls, row_key, start=None, finish=None, configuration=Configuration):
+        """
+        Deletes the instances in row row_key with column keys from start to
+        finish (both inclusive) with one batch_mutate. A bucketed model needs
+        both bounds; the buckets strictly between theirs are deleted as whole
+        rows.
+
+        Cassandra 0.7 rejects SliceRange Deletions, so the columns of the rows
+        the range covers only in part are read first and deleted by name. Set
+        Configuration.range_deletions on later versions to delete them without
+        reading.
+        """
+        start, finish = cls._pack_column_key(start), cls._pack_column_key(finish)
+        row_key = cls._row_key[1]._db_format(row_key)
+        edge_columns = None
+        if not configuration.range_deletions:
+            start_name, finish_name = cls._slice_range(start, finish, False)
+            edges = [key for key, whole in cls._delete_range_rows(row_key, start, finish) if not whole]
+            names = yield _gather([cls._column_names(key, start_name, finish_name, configuration) for key in edges])
+            edge_columns = dict(zip(edges, names))
+        mutation_map = cls._mutation_map_for_delete_range(row_key, start, finish, edge_columns)
+        if mutation_map:
+            yield configuration.cassandra_client.batch_mutate(mutation_map)
 
     @classmethod
     def _result_to_instance(cls, row_key, column_key, result):
         o = cls(is_new=False)
-        o._setattr(o._row_key[0], row_key, filter=False)
-        o._setattr(o._column_key[0], column_key, filter=False)
+        o._load_key(cls._row_key[0], row_key)
+        o._load_key(cls._column_key[0], column_key)
+        old_format = {}
+        packed = False
         for column in result:
+            if len(column.column.name) == 16 and cls._layout is not None:
+                for name, value in cls._layout.unpack(column.column.value):
+                    o._setattr_from_db(name, value)
+                packed = True
+                continue
             id, name = cls._unpack_column(column.column.name)
             if name not in (o._row_key[0], o._column_key[0]):
-                o._setattr_from_db(name, column.column.value)
+                if cls._layout is not None or (cls._column_tags is not None and column.column.name[16:] == name):
+                    old_format[name] = column.column.value
+                else:
+                    o._setattr_from_db(name, column.column.value)
+        if packed:
+            # The packed column holds the whole object, unset attributes included
+            old_format = {}
+        for name, value in old_format.items():
+            # A column in the current format is newer than an old one of the same attribute
+            if not o._fetched >> o._attribute_index[name] & 1:
+                o._setattr_from_db(name, value)
+                # Rewritten in the current format on the next save
+                o._saved[o._attribute_index[name]] = None
+                o._dirty |= 1 << o._attribute_index[name]
         return o
 
-    @classmethod
-    def _result_to_instances(cls, row_key, result):
-        results = {}
-        for column in result:
-            column_key, name = cls._unpack_column(column.column.name)
-            o = results.get(column_key)
-            if o is None:
-                o = cls(is_new=False)
-                o._setattr(o._row_key[0], row_key, filter=False)
-                o._setattr(o._column_key[0], column_key, filter=False)
-                results[column_key] = o
-                
-            if name not in (o._row_key[0], o._column_key[0]):
-                o._setattr_from_db(name, column.column.value)
-        return results.values()
         
         
 #     @classmethod
@@ -137,37 +465,166 @@ class ColumnModel(BaseModel):
 #         return columns
 
 
+    @classmethod
+    def _slice_def_for_query(cls, query):
+        """
+        Returns the packed row key, the column key bounds as column name
+        prefixes (None when open), whether to read backwards and the column
+        name prefixes a strict bound excludes, for a query with an EQ
+        expression on the row key and optional range expressions on the
+        column key.
+        """
+        row_key = None
+        low = high = None
+        exclude = []
+        for e in query._expressions:
+            if isinstance(e, AnyOf) or e.column_name not in (cls._row_key[0], cls._column_key[0]):
+                raise Exception('ColumnModel queries only support an EQ expression on the row key and ranges on the column key.')
+            if e.column_name == cls._row_key[0]:
+                if e.op != IndexOperator.EQ:
+                    raise Exception('ColumnModel queries only support an EQ expression on the row key.')
+                row_key = e.value
+                continue
+            name_key = cls._name_key(e.value)
+            if e.op in (IndexOperator.GT, IndexOperator.GTE):
+                low = name_key if low is None else max(low, name_key)
+            elif e.op in (IndexOperator.LT, IndexOperator.LTE):
+                high = name_key if high is None else min(high, name_key)
+            else:
+                raise Exception('ColumnModel queries only support ranges on the column key.')
+            if e.op in (IndexOperator.GT, IndexOperator.LT):
+                exclude.append(name_key)
+        if row_key is None:
+            raise Exception('ColumnModel queries need an EQ expression on the row key.')
+
+        sorts = query._sorts or [cls._column_key[0]]
+        if len(sorts) > 1:
+            raise Exception("Multiple order clauses not supported.")
+        if sorts[0].lstrip('+-') != cls._column_key[0]:
+            raise Exception('ColumnModel queries can only be sorted on the column key.')
+        if sorts[0].startswith('-'):
+            return row_key, high, low, True, exclude
+        return row_key, low, high, False, exclude
+
+    @classmethod
+    def _slice_range(cls, start, finish, reversed):
+        """
+        Returns the get_slice start and finish column names that cover every
+        column of the objects with column name prefixes from start to finish.
+        """
+        low, high = (finish, start) if reversed else (start, finish)
+        low = '' if low is None else low
+        # Column names start with the key, so they sort from it up to key + '\xff'
+        high = '' if high is None else high + '\xff'
+        return (high, low) if reversed else (low, high)
+
+    @classmethod
+    def _column_pages(cls, row_key, start=None, finish=None, reversed=False, page_size=None, exclude=(), read_ahead=True, configuration=Configuration):
+        """
+        Returns a ColumnSliceIterator over the instances in the packed row key
+        row_key with column name prefixes from start to finish, or for a
+        bucketed model a MergedSliceIterator over the bucket rows.
+        """
+        page_size = page_size or configuration.column_page_size
+        start_name, finish_name = cls._slice_range(start, finish, reversed)
+        row_key_value = cls._row_key[1].from_db_value(row_key)
+        client = configuration.cassandra_client
+
+        def hydrate(objects):
+            instances = []
+            for column_key, columns in objects:
+                if column_key in exclude:
+                    continue
+                o = cls._result_to_instance(row_key_value, cls._column_key[1].from_db_value(cls._key_from_name(column_key)), columns)
+                o._post_get()
+                instances.append(o)
+            return instances
+
+        if cls._bucket_size is None:
+            def fetch(start, count):
+                return client.get_slice(row_key, cls.Meta.column_family, start=start, finish=finish_name, count=count, reverse=reversed)
+            return ColumnSliceIterator(fetch, page_size, cls._columns_per_object, start_name, reversed, hydrate, read_ahead)
+
+        keys = cls._bucket_row_keys(row_key, start, finish)
+        iterators = {}
+        for key in keys:
+            def fetch(start, count, key=key):
+                return client.get_slice(key, cls.Meta.column_family, start=start, finish=finish_name, count=count, reverse=reversed)
+            iterators[key] = ColumnSliceIterator(fetch, page_size, cls._columns_per_object, start_name, reversed, read_ahead=False)
+
+        def fetch_first(start, count):
+            # The first slice of every bucket, multiget_chunk_size buckets per multiget_slice
+            semaphore = defer.DeferredSemaphore(configuration.multiget_concurrency)
+            chunk_size = configuration.multiget_chunk_size
+            d = _gather([semaphore.run(client.multiget_slice, keys[i:i + chunk_size], cls.Meta.column_family,
+                start=start, finish=finish_name, count=count, reverse=reversed) for i in range(0, len(keys), chunk_size)])
+            d.addCallback(lambda results: dict(item for result in results for item in result.items()))
+            return d
+        return MergedSliceIterator(iterators, fetch_first, page_size, reversed, hydrate)
+
+    @classmethod
+    @inlineCallbacks
+    def _read_pages(cls, pages, count=None):
+        """Collects the instances of pages, stopping once count of them (all when None) are read."""
+        results = []
+        for page in pages:
+            instances = yield page
+            results.extend(instances)
+            if count is not None and len(results) >= count:
+                break
+        returnValue(results[:count])
+
+    @classmethod
+    def _pack_column_key(cls, column_key):
+        """Returns the column name prefix of column_key, or None."""
+        return None if column_key is None else cls._name_key(cls._column_key[1]._db_format(column_key))
+
+    @classmethod
+    def iterate(cls, row_key, start=None, finish=None, reversed=False, page_size=None, configuration=Configuration):
+        """
+        Streams the instances in row row_key as pages of at most page_size
+        (default Configuration.column_page_size), in column key order, one
+        get_slice per page. start and finish bound the column keys, both
+        inclusive; reversed reads backwards, from start down to finish.
+
+        A bucketed model (Meta.row_bucket) needs both start and finish: the
+        bucket rows between their times are read concurrently and merged.
+
+        Usage:
+            for page in MyModel.iterate(row_key, start=first_id):
+                instances = yield page
+        """
+        return cls._column_pages(cls._row_key[1]._db_format(row_key), cls._pack_column_key(start), cls._pack_column_key(finish),
+            reversed, page_size, configuration=configuration)
+
+    @classmethod
+    def slice(cls, row_key, start=None, finish=None, reversed=False, count=None, configuration=Configuration):
+        """Returns the first count instances (all when None) that iterate() would stream."""
+        page_size = configuration.column_page_size if count is None else min(count, configuration.column_page_size)
+        pages = cls._column_pages(cls._row_key[1]._db_format(row_key), cls._pack_column_key(start), cls._pack_column_key(finish),
+            reversed, page_size, read_ahead=count is None or count > page_size, configuration=configuration)
+        return cls._read_pages(pages, count)
+
+    @classmethod
+    def iterate_query(cls, query=None, page_size=100, configuration=Configuration):
+        """Streams the matches of query as pages of instances; offset and limit are not applied."""
+        if query is None:
+            raise Exception('query is None!')
+        row_key, start, finish, reversed, exclude = cls._slice_def_for_query(query)
+        return cls._column_pages(row_key, start, finish, reversed, page_size, exclude, configuration=configuration)
+
     @classmethod
     @inlineCallbacks
     def execute_query(cls, query=None, configuration=Configuration):
         if query is None:
             raise Exception('query is None!')
-        
-        # Debug
-        # for e in query._expressions:
-        #     print e
-        #     
-        # return
-        
-        # From .get
-        # names = [cls._pack_column(column_key, x) for x,v in cls._attributes.items() if not x in (cls._row_key[0], cls._column_key[0])]
-        #         
-        # record = yield configuration.cassandra_client.get_slice(row_key.bytes, cls.Meta.column_family, names=names)
-        #         
-        # if record == []:
-        #     returnValue(None)
-        # o = cls._result_to_instance(row_key, column_key, record)
-        # o._post_get()
-        # returnValue(o)
-        
-        row_key, kwargs = cls._slice_def_for_query(query)
-        
-        search_results = yield configuration.cassandra_client.get_slice(row_key, cls.Meta.column_family, **kwargs)
-        
-        results = cls._results_to_instances(search_results)
 
-        sorted_results = sorted(results, key=attrgetter(order_key_name))
-        if reverse_sort:
-            sorted_results.reverse()
-        
-        returnValue(QueryResult(sorted_results, None))
+        offset = query._offset or 0
+        limit = query._limit or 25
+        row_key, start, finish, reversed, exclude = cls._slice_def_for_query(query)
+        # Stop reading once offset + limit instances are in
+        needed = offset + limit
+        page_size = min(needed, configuration.column_page_size)
+        pages = cls._column_pages(row_key, start, finish, reversed, page_size, exclude, read_ahead=needed > page_size, configuration=configuration)
+        results = yield cls._read_pages(pages, needed)
+        returnValue(QueryResult(results[offset:], None))
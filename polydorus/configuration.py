@@ -2,6 +2,35 @@ class Configuration(object):
     cassandra_client = None
     count = 10000
     column_count = count
+    # Rows scanned by Query.estimate() before extrapolating the total
+    estimate_sample_size = 1000
+    # Matches read per indexed EQ expression when the query planner has no statistics to choose between them
+    planner_sample_size = 100
+    # ColumnModel instances read per get_slice when paging through a row
+    column_page_size = 1000
+    multiget_chunk_size = 100
+    multiget_concurrency = 4
+    # Row keys per batch_mutate and batch_mutate calls in flight for save_many()
+    save_chunk_rows = 200
+    save_concurrency = 4
+    coalesce_gets = True
+    # Read-through cache for RowModel.get; a cache_size of 0 disables it.
+    # Models can override these with Meta.cache_size, cache_ttl and cache_negative_ttl.
+    cache_size = 0
+    cache_ttl = 60
+    cache_negative_ttl = 5
+    # Keep fetched columns as raw bytes and decode each attribute on first read.
+    # Models can override this with Meta.lazy_hydration.
+    lazy_hydration = False
+    # Queue saves and write them out every write_behind_interval seconds, or once
+    # write_behind_max_rows row keys are queued (see WriteBehindBuffer).
+    # Models can override write_behind with Meta.write_behind.
+    write_behind = False
+    write_behind_interval = 1.0
+    write_behind_max_rows = 1000
+    # Let ColumnModel.delete_range delete column ranges with SliceRange Deletions,
+    # which Cassandra 0.7 rejects; off, it reads the columns and deletes them by name.
+    range_deletions = False
     
     def __init__(self):
         raise Exception('Cannot create instances of Configuration -- use the class!')
\ No newline at end of file
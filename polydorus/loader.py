@@ -0,0 +1,39 @@
+from twisted.internet import defer
+
+
+class BatchLoader(object):
+    """
+    Coalesces the keys requested during one reactor turn into a single call to
+    batch_load. batch_load takes a list of unique keys and returns (a Deferred
+    firing with) a dict of key -> value; keys missing from the dict load as
+    None. Every caller of load() gets its own Deferred, even for duplicate keys.
+    """
+    def __init__(self, batch_load, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._batch_load = batch_load
+        self._clock = clock
+        self._pending = {}
+        self._call = None
+
+    def load(self, key):
+        d = defer.Deferred()
+        self._pending.setdefault(key, []).append(d)
+        if self._call is None:
+            self._call = self._clock.callLater(0, self._dispatch)
+        return d
+
+    def _dispatch(self):
+        pending, self._pending, self._call = self._pending, {}, None
+
+        def deliver(values):
+            for key, waiting in pending.items():
+                for d in waiting:
+                    d.callback(values.get(key))
+
+        def fail(failure):
+            for waiting in pending.values():
+                for d in waiting:
+                    d.errback(failure)
+
+        defer.maybeDeferred(self._batch_load, pending.keys()).addCallbacks(deliver, fail)
@@ -0,0 +1,150 @@
+import operator
+from attributes import IndexOperator
+
+_comparisons = {
+    IndexOperator.GT: operator.gt,
+    IndexOperator.GTE: operator.ge,
+    IndexOperator.LT: operator.lt,
+    IndexOperator.LTE: operator.le,
+}
+
+_symbols = {
+    IndexOperator.EQ: '==',
+    IndexOperator.NE: '!=',
+    IndexOperator.GT: '>',
+    IndexOperator.GTE: '>=',
+    IndexOperator.LT: '<',
+    IndexOperator.LTE: '<=',
+}
+
+
+class QueryPlan(object):
+    """
+    How a RowModel query runs: Cassandra scans the index for driver (an EQ
+    expression on an indexed attribute) and every other expression is
+    checked locally against the scanned columns.
+
+    Running the plan adds to rows_scanned, rows_returned and bytes_decoded;
+    str() of an executed plan is what Query.explain() reports.
+    """
+    def __init__(self, model_class, driver, filters, estimate=None):
+        self.model_class = model_class
+        self.driver = driver
+        self.filters = filters
+        self.estimate = estimate
+        # Columns the scan has to read for the local predicate
+        self.columns = sorted(set(e.column_name for e in filters))
+        self.sort_index = None
+        self.rows_scanned = 0
+        self.rows_returned = 0
+        self.bytes_decoded = 0
+        self.matches = self._compile(filters)
+
+    def _compile(self, filters):
+        """Returns one predicate over a dict of packed column values that checks all of filters."""
+        byte_tests = []
+        range_tests = []
+        for e in filters:
+            attribute = self.model_class._attributes.get(e.column_name)
+            if attribute is None: raise Exception('Unknown attribute: %s' % e.column_name)
+            if e.op == IndexOperator.EQ:
+                byte_tests.append((e.column_name, lambda v, packed=e.value: v == packed))
+            elif e.op == IndexOperator.NE:
+                # NE holds a validated value; rows without the column are not excluded
+                byte_tests.append((e.column_name, lambda v, packed=attribute.to_db_value(e.value): v is None or v != packed))
+            else:
+                range_tests.append((e.column_name, self._range_test(attribute, _comparisons[e.op], attribute.from_db_value(e.value))))
+        # Comparing packed bytes is cheaper than decoding, so those tests go first
+        tests = byte_tests + range_tests
+
+        def matches(columns):
+            for name, test in tests:
+                if not test(columns.get(name)):
+                    return False
+            return True
+        return matches
+
+    def _range_test(self, attribute, compare, value):
+        def test(packed):
+            if packed is None:
+                return False
+            self.bytes_decoded += len(packed)
+            return compare(attribute.from_db_value(packed), value)
+        return test
+
+    def filter(self, rows):
+        """Counts rows as scanned and returns (row, {name: packed value}) for those that pass the local predicate."""
+        self.rows_scanned += len(rows)
+        matched = []
+        for r in rows:
+            columns = dict((c.column.name, c.column.value) for c in r.columns)
+            if self.matches(columns):
+                matched.append((r, columns))
+        return matched
+
+    def decode(self, name, packed):
+        """Decodes a scanned column, counting its bytes."""
+        if packed is None:
+            return None
+        self.bytes_decoded += len(packed)
+        return self.model_class._attributes[name].from_db_value(packed)
+
+    def _describe(self, e):
+        value = e.value if e.op == IndexOperator.NE else self.model_class._attributes[e.column_name].from_db_value(e.value)
+        return '%s %s %r' % (e.column_name, _symbols[e.op], value)
+
+    def __str__(self):
+        if self.sort_index is not None:
+            lines = ['Sort index read of %s for %s' % (self.sort_index, self._describe(self.driver))]
+        else:
+            lines = ['Index scan of %s for %s' % (self.model_class.Meta.column_family, self._describe(self.driver))]
+            if self.estimate is not None:
+                lines[0] += ' (estimated %d rows)' % round(self.estimate)
+        if self.filters:
+            lines.append('Local filter: %s' % ' and '.join(self._describe(e) for e in self.filters))
+        lines.append('Rows scanned: %d, rows returned: %d, bytes decoded: %d' % (self.rows_scanned, self.rows_returned, self.bytes_decoded))
+        return '\n'.join(lines)
+
+
+class QueryPlanner(object):
+    """
+    Chooses the driving expression of a model's queries: the indexed EQ
+    expression expected to match the fewest rows. Keeps, per attribute, a
+    moving average of the rows one EQ value matched in past scans and samples.
+    """
+    weight = 0.2
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.selectivity = {}
+
+    def _candidates(self, expressions):
+        attributes = self.model_class._attributes
+        return [e for e in expressions if e.op == IndexOperator.EQ and getattr(attributes.get(e.column_name), 'indexed', False)]
+
+    def unknown(self, expressions):
+        """Returns the candidate expressions without statistics, when there is a choice to make."""
+        candidates = self._candidates(expressions)
+        if len(candidates) < 2:
+            return []
+        return [e for e in candidates if e.column_name not in self.selectivity]
+
+    def record(self, name, rows):
+        """Folds the number of rows an EQ value of name matched into its statistics."""
+        old = self.selectivity.get(name)
+        self.selectivity[name] = float(rows) if old is None else old + self.weight * (rows - old)
+
+    def plan(self, expressions, samples=None):
+        """Returns the QueryPlan for expressions; samples maps attribute names to rows matched by this query's values."""
+        candidates = self._candidates(expressions)
+        if not candidates:
+            raise Exception('Queries need an EQ expression on an indexed attribute.')
+        samples = samples or {}
+
+        def estimate(e):
+            if e.column_name in samples:
+                return samples[e.column_name]
+            return self.selectivity.get(e.column_name)
+        # Expressions without an estimate go last, keeping the order they were given in
+        driver = min(candidates, key=lambda e: (estimate(e) is None, estimate(e)))
+        return QueryPlan(self.model_class, driver, [e for e in expressions if e is not driver], estimate(driver))
@@ -1,10 +1,54 @@
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+import collections
+from utils import _gather
+
+
+class TotalEstimate(object):
+    """
+    The number of matches of a query. When exact is false, total was
+    extrapolated from a sample and error is the half-width of its 95%
+    confidence interval.
+    """
+    def __init__(self, total, error=0, exact=True):
+        self.total = total
+        self.error = error
+        self.exact = exact
+
+    def __str__(self):
+        if self.exact:
+            return "%s" % self.total
+        return "about %s (+/- %s)" % (self.total, self.error)
+
+
+class AnyOf(object):
+    """
+    A disjunction for Query.filter(): rows matching any of the expressions
+    match. GenericAttribute.in_() builds one from a list of values.
+
+    Usage:
+        MyModel.filter(AnyOf(MyModel.name == 'a', MyModel.city == 'b'))
+    """
+    def __init__(self, *expressions):
+        self.expressions = list(expressions)
+        # True when no row can match two of the expressions, as with in_()
+        self.disjoint = False
+
+    def __repr__(self):
+        return "AnyOf(%s)" % ", ".join(repr(e) for e in self.expressions)
+
+
 class QueryResult(object):
     _results = None
     _count = None
+    _count_error = 0
+    _next_cursor = None
     
-    def __init__(self, results, count):
+    def __init__(self, results, count, count_error=0, next_cursor=None):
         self._results = results
         self._count = count
+        self._count_error = count_error
+        self._next_cursor = next_cursor
     
     def __len__(self):
         return len(self._results)
@@ -32,6 +76,219 @@ class QueryResult(object):
     def total(self):
         return self._count
 
+    @property
+    def total_error(self):
+        """Half-width of the 95% confidence interval of an approximate total; 0 when total is exact."""
+        return self._count_error
+
+    @property
+    def next_cursor(self):
+        """Opaque token for Query.after() that resumes right after the last result; None when the page was not full."""
+        return self._next_cursor
+
+
+class QueryIterator(object):
+    """Pages through the rows matched by a query without loading them all at once.
+
+    Iterating yields one Deferred per page; wait on each before asking for
+    the next one, which raises otherwise. As soon as a page arrives the following one is requested,
+    so the next round trip overlaps with the caller's work on the current page.
+
+    Usage:
+        for page in MyModel.filter(expression).iterate(page_size=500):
+            instances = yield page
+            for x in instances:
+                print x
+    """
+    def __init__(self, fetch, page_size, hydrate=None, read_ahead=True):
+        self._fetch = fetch
+        self._page_size = page_size
+        self._hydrate = hydrate
+        self._read_ahead = read_ahead
+        self._last_key = None
+        self._pending = None
+        self._exhausted = False
+        self._waiting = False
+
+    def __iter__(self):
+        while self._pending is not None or not self._exhausted:
+            yield self.next_page()
+
+    def _request(self):
+        start_key = self._last_key
+        # start_key is inclusive, so ask for one extra row to replace the one already seen
+        count = self._page_size if start_key is None else self._page_size + 1
+        d = self._fetch(start_key or '', count)
+        d.addCallback(self._received, start_key, count)
+        return d
+
+    def _received(self, rows, start_key, count):
+        if len(rows) < count:
+            self._exhausted = True
+        if rows:
+            self._last_key = rows[-1].key
+            if rows[0].key == start_key:
+                rows = rows[1:]
+        return rows
+
+    def _request_next(self, rows):
+        if self._pending is None and not self._exhausted:
+            self._pending = self._request()
+        return rows
+
+    @property
+    def exhausted(self):
+        """True once every page has been handed out."""
+        return self._exhausted and self._pending is None
+
+    def _arrived(self, result):
+        self._waiting = False
+        return result
+
+    def next_page(self):
+        # Until a page arrives it is unknown where the next one starts, or whether there is one
+        if self._waiting:
+            raise Exception('The previous page has not arrived yet; wait on it before asking for the next one.')
+        if self._pending is not None:
+            d, self._pending = self._pending, None
+        elif self._exhausted:
+            return defer.succeed([])
+        else:
+            d = self._request()
+        if self._read_ahead:
+            d.addCallback(self._request_next)
+        if self._hydrate is not None:
+            d.addCallback(self._hydrate)
+        self._waiting = True
+        d.addBoth(self._arrived)
+        return d
+
+
+class ColumnSliceIterator(QueryIterator):
+    """Pages through the objects stored in one wide row, in column name order.
+
+    Each object is a run of columns sharing a 16 byte column key prefix,
+    expected to be at most columns_per_object long.
+    fetch(start, count) returns a Deferred firing with up to count columns
+    from the column name start. Pages hold up to page_size objects as
+    (column key, columns) pairs; when a slice ends inside an object, that
+    object starts the next page instead, so no object is split.
+    """
+    def __init__(self, fetch, page_size, columns_per_object, start='', reversed=False, hydrate=None, read_ahead=True):
+        super(ColumnSliceIterator, self).__init__(fetch, page_size, hydrate=hydrate, read_ahead=read_ahead)
+        # One column more than page_size whole objects, so a full slice always holds a whole first object
+        self._count = page_size * columns_per_object + 1
+        self._start = start
+        self._reversed = reversed
+
+    def _request(self):
+        d = self._fetch(self._start, self._count)
+        d.addCallback(self._received)
+        return d
+
+    def _received(self, columns):
+        objects = []
+        for c in columns:
+            key = c.column.name[:16]
+            if objects and objects[-1][0] == key:
+                objects[-1][1].append(c)
+            else:
+                objects.append((key, [c]))
+
+        resume = None
+        if len(columns) == self._count:
+            # The slice may have cut the last object short
+            resume = objects.pop()[0]
+            if not objects:
+                # One object filled the whole slice; read it again with room for all of it
+                self._count *= 2
+                return self._request()
+        if len(objects) > self._page_size:
+            resume = objects[self._page_size][0]
+            del objects[self._page_size:]
+        if resume is None:
+            self._exhausted = True
+        else:
+            # Slice starts are inclusive; in reverse, start after every column of the object
+            self._start = resume + '\xff' if self._reversed else resume
+        return objects
+
+
+class MergedSliceIterator(object):
+    """Streams the objects of several rows, e.g. the time buckets of a
+    ColumnModel row, as one sequence in column name order.
+
+    iterators maps each row key to a ColumnSliceIterator over that row,
+    without read-ahead. They all start from the same column name, so their
+    first slices come from one call of fetch_first(start, count), which
+    returns a Deferred firing with {row key: columns}. After that, the rows
+    that run out of objects are read again concurrently. Iterate it like a
+    QueryIterator, waiting on each page before asking for the next one.
+    """
+    def __init__(self, iterators, fetch_first, page_size, reversed=False, hydrate=None):
+        self._iterators = iterators
+        self._fetch_first = fetch_first
+        self._page_size = page_size
+        self._reversed = reversed
+        self._hydrate = hydrate
+        self._buffers = dict((key, collections.deque()) for key in iterators)
+        self._started = False
+        self._waiting = False
+
+    def __iter__(self):
+        while not self.exhausted:
+            yield self.next_page()
+
+    @property
+    def exhausted(self):
+        """True once every page has been handed out."""
+        return self._started and not self._refills() and not [b for b in self._buffers.values() if b]
+
+    def _refills(self):
+        return [key for key, it in self._iterators.items() if not self._buffers[key] and not it.exhausted]
+
+    @inlineCallbacks
+    def _refill(self, keys):
+        if not self._started:
+            self._started = True
+            first = self._iterators[keys[0]]
+            slices = yield self._fetch_first(first._start, first._count)
+            pages = yield _gather([maybeDeferred(self._iterators[key]._received, slices.get(key, [])) for key in keys])
+        else:
+            pages = yield _gather([self._iterators[key].next_page() for key in keys])
+        for key, objects in zip(keys, pages):
+            self._buffers[key].extend(objects)
+
+    def _arrived(self, result):
+        self._waiting = False
+        return result
+
+    def next_page(self):
+        if self._waiting:
+            raise Exception('The previous page has not arrived yet; wait on it before asking for the next one.')
+        self._waiting = True
+        d = self._next_page()
+        d.addBoth(self._arrived)
+        return d
+
+    @inlineCallbacks
+    def _next_page(self):
+        choose = max if self._reversed else min
+        page = []
+        while len(page) < self._page_size:
+            # An object can only be handed out once every row that may hold a smaller one has been read
+            keys = self._refills()
+            if keys:
+                yield self._refill(keys)
+                continue
+            buffered = [b for b in self._buffers.values() if b]
+            if not buffered:
+                break
+            page.append(choose(buffered, key=lambda b: b[0][0]).popleft())
+        if self._hydrate is not None:
+            page = self._hydrate(page)
+        returnValue(page)
+
 
 class Query(object):
     """Usage: 
@@ -45,6 +302,7 @@ class Query(object):
     _sorts = []
     _offset = None
     _limit = None
+    _after = None
     _attributes = []
     
     def __init__(self, cls, expression=None, sort=None, attributes=None):
@@ -59,19 +317,47 @@ class Query(object):
         self._attributes += other._attributes
         self._offset = other._offset or self._offset
         self._limit = other._limit or self._limit
+        self._after = other._after or self._after
         return self
         
     def filter(self, expression):
         return self & Query(self._model_class, expression=expression)
         
     def __str__(self):
-        return "Query object (expressions: %s; sorts: %s; offset: %s, limit: %s, attributes: %s)" % (self._expressions, self._sorts, self._offset, self._limit, self._attributes)
+        return "Query object (expressions: %s; sorts: %s; offset: %s, limit: %s, after: %s, attributes: %s)" % (self._expressions, self._sorts, self._offset, self._limit, self._after, self._attributes)
+
+    def _branches(self):
+        """
+        Expands AnyOf filters into one list of plain expressions per
+        combination of their alternatives. Returns those lists and whether no
+        row can match more than one of them.
+        """
+        branches = [[]]
+        disjoint = True
+        for e in self._expressions:
+            if isinstance(e, AnyOf):
+                branches = [b + [alternative] for b in branches for alternative in e.expressions]
+                disjoint = disjoint and e.disjoint
+            else:
+                branches = [b + [e] for b in branches]
+        return branches, disjoint
 
     def sort(self, sort):
         return self & Query(self._model_class, sort=sort)
         
     def attributes(self, attributes):
+        """Restricts the query to the named attribute(s); results become read-only rows instead of model instances."""
         return self & Query(self._model_class, attributes=attributes)
+
+    def _projection(self):
+        """Returns the attribute names selected with attributes(), or None when whole instances are wanted."""
+        names = []
+        for a in self._attributes:
+            if isinstance(a, basestring):
+                names.append(a)
+            else:
+                names.extend(a)
+        return names or None
         
     def offset(self, new_offset):
         self._offset = new_offset
@@ -80,6 +366,30 @@ class Query(object):
     def limit(self, new_limit):
         self._limit = new_limit
         return self
+
+    def after(self, cursor):
+        """
+        Resumes from QueryResult.next_cursor of a previous page, which must come
+        from the same filters and sort. Unlike offset(), reading deep pages
+        from a sort index costs no more than reading the first one.
+        """
+        self._after = cursor
+        return self
     
-    def execute(self):
-        return self._model_class.execute_query(self)
\ No newline at end of file
+    def execute(self, approximate_total=False):
+        if approximate_total:
+            return self._model_class.execute_query(self, approximate_total=True)
+        return self._model_class.execute_query(self)
+
+    def explain(self, approximate_total=False):
+        """Executes the query and returns its QueryPlan; str() of the plan describes how it ran."""
+        return self._model_class.explain_query(self, approximate_total=approximate_total)
+
+    def count(self):
+        return self._model_class.count_query(self)
+
+    def iterate(self, page_size=100):
+        return self._model_class.iterate_query(self, page_size=page_size)
+
+    def estimate(self, sample_size=None):
+        return self._model_class.estimate_query(self, sample_size=sample_size)
\ No newline at end of file
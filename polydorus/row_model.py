@@ -4,7 +4,7 @@ import uuid
 import logging
 import datetime
 from pytz import utc
-from telephus.cassandra.ttypes import InvalidRequestException, CfDef, ColumnDef, IndexExpression, IndexOperator
+from telephus.cassandra.ttypes import InvalidRequestException, CfDef, ColumnDef, IndexExpression, IndexOperator, Column, Deletion, SlicePredicate
 import copy
 import math
 import decimal
@@ -13,10 +13,20 @@ from netaddr.ip import IPAddress
 from netaddr.strategy import ipv4
 from dateutil import parser
 from operator import attrgetter, itemgetter
+from collections import namedtuple
+import collections
+import base64
+import struct
+import heapq
 from attributes import *
 from configuration import Configuration
-from query import Query, QueryResult
+from query import Query, QueryResult, QueryIterator, TotalEstimate
+from utils import TopK, _Inverted, _gather, timestamp, time_uuid, token, TOKEN_RING_SIZE
+from loader import BatchLoader
+from cache import LRUCache
+from planner import QueryPlanner
 from base_model import BaseModel, BaseModelMeta
+from write_behind import write_behind_buffer
 
 
 class RowModelMeta(BaseModelMeta):
@@ -27,28 +37,144 @@ class RowModelMeta(BaseModelMeta):
                 cls._row_key = (k, v)
         if cls._row_key is None and cls.Meta.column_family:
             raise Exception('No row_key found for non-primitive model.')
+
+        # Meta.sort_indexes = [(primary, secondary), ...] keeps, for each value of
+        # primary, a wide row of the model's row keys ordered by secondary.
+        # The index orders by packed bytes, so secondary must have an int, long
+        # or unicode db type, whose bytes order like the values (not JSON).
+        cls._sort_indexes = {}
+        for primary, secondary in getattr(cls.Meta, 'sort_indexes', ()):
+            for k in (primary, secondary):
+                if k not in cls._attributes:
+                    raise Exception('Unknown attribute in sort index: %s' % k)
+            if not cls._attributes[secondary]._sort_ordered:
+                raise Exception('Sort index on %s: only attributes stored as int, long or unicode sort the same in an index.' % secondary)
+            cls._sort_indexes[(primary, secondary)] = '%s_by_%s_and_%s' % (cls.Meta.column_family, primary, secondary)
+        cls._sort_index_attributes = set(k for pair in cls._sort_indexes for k in pair)
+        cls._loaders = {}
+        cls._cache = None
+        cls._projection_types = {}
+        cls._planner = QueryPlanner(cls)
         
+_not_cached = object()
+# A decoded QueryResult.next_cursor: the sort index column name of the last row
+# returned and its (sort value, row key) position for comparing scanned rows
+Cursor = namedtuple('Cursor', ('column', 'position'))
+
+def _list_stream(items):
+    """Returns a stream function (see _merge_streams) handing out items as a single page."""
+    pages = [items]
+    return lambda: defer.succeed(pages.pop() if pages else [])
+
+@inlineCallbacks
+def _merge_streams(streams, needed, reverse=False):
+    """
+    K-way merge of sorted streams of (sort key, row key) pairs. A stream is a
+    function returning a Deferred for its next page, empty once exhausted;
+    a stream's next page is only requested when the merge has used up its
+    previous one. Returns the first needed pairs with distinct row keys.
+    """
+    pages = yield _gather([stream() for stream in streams])
+    buffers = [collections.deque(page) for page in pages]
+    heap = []
+
+    def push(i):
+        sort_key, key = buffers[i].popleft()
+        # Each stream has one entry in the heap at a time, so entries never tie past i
+        heapq.heappush(heap, (_Inverted(sort_key) if reverse else sort_key, i, sort_key, key))
+
+    for i, buffer in enumerate(buffers):
+        if buffer:
+            push(i)
+    merged = []
+    seen = set()
+    while heap and len(merged) < needed:
+        heap_key, i, sort_key, key = heapq.heappop(heap)
+        if key not in seen:
+            seen.add(key)
+            merged.append((sort_key, key))
+        if not buffers[i]:
+            page = yield streams[i]()
+            buffers[i].extend(page)
+        if buffers[i]:
+            push(i)
+    returnValue(merged)
+
+
 class RowModel(BaseModel):
     __metaclass__ = RowModelMeta
     _row_key = None
-    
+
     def _pre_save(self):
         if self._is_new:
-            self._setattr(self._row_key[0], uuid.uuid1(), filter=False)        
+            self._setattr(self._row_key[0], time_uuid(), filter=False)        
     
+    def _identity_key(self):
+        return getattr(self, self._row_key[0])
+
     def _mutation_map_for_save(self):
-        insert_dict = {}
-        for k in self._dirty:
-            v = self._attribute_values[k]
-            if k != self._row_key[0]:
-                insert_dict[k] = self._getattr_for_db(k)
-        
-        row_key = self._getattr_for_db(self._row_key[0])
+        # A copy: _changed_attributes returns the record of what this save writes, and
+        # callers such as save_many merge other saves into the returned map
+        insert_dict = dict(self._changed_attributes())
+        # The row key is not stored as a column; it is among the changes only until the first save
+        row_key = insert_dict.pop(self._row_key[0], None) or self._db_value(self._row_key[0])
         
         mutation_map = {}
-        mutation_map.update({row_key: {self.Meta.column_family: insert_dict}})
+        if insert_dict:
+            mutation_map.update({row_key: {self.Meta.column_family: insert_dict}})
+        if self._sort_indexes:
+            self._add_sort_index_mutations(mutation_map, row_key, self._saved_index_values(), self._index_values_for_save())
         return mutation_map
-        
+
+    def _mutation_map_for_delete(self):
+        row_key = self._attributes[self._row_key[0]].to_db_value(getattr(self, self._row_key[0]))
+        mutation_map = {row_key: {self.Meta.column_family: [Deletion(timestamp=timestamp())]}}
+        self._add_sort_index_mutations(mutation_map, row_key, self._saved_index_values(), {})
+        return mutation_map
+
+    def _index_values_for_save(self):
+        """
+        Returns the packed values of the sort index attributes after this save:
+        the changed ones as packed for it, the others as last read or written,
+        since re-packing a decoded value does not always give the stored bytes.
+        """
+        saving = self._saving or {}
+        return dict((k, saving[k] if k in saving else self._saved_value(k)) for k in self._sort_index_attributes)
+
+    def _saved_index_values(self):
+        """Returns the packed values of the sort index attributes as last read or written, which locate the current index entries."""
+        return dict((k, self._saved_value(k)) for k in self._sort_index_attributes)
+
+    def _add_sort_index_mutations(self, mutation_map, row_key, old_values, new_values):
+        """Adds the mutations that move row_key's sort index entries from old_values to new_values (both packed)."""
+        ts = timestamp()
+        for (primary, secondary), cf_name in self._sort_indexes.items():
+            old_row, new_row = old_values.get(primary), new_values.get(primary)
+            old_column = new_column = None
+            if old_row is not None:
+                old_column = self._attributes[secondary]._sort_format(old_values.get(secondary)) + row_key
+            if new_row is not None:
+                new_column = self._attributes[secondary]._sort_format(new_values.get(secondary)) + row_key
+            if (old_row, old_column) == (new_row, new_column):
+                continue
+            if old_row is not None:
+                deletion = Deletion(timestamp=ts, predicate=SlicePredicate(column_names=[old_column]))
+                mutation_map.setdefault(old_row, {}).setdefault(cf_name, []).append(deletion)
+            if new_row is not None:
+                mutation_map.setdefault(new_row, {}).setdefault(cf_name, []).append(Column(name=new_column, value='', timestamp=ts))
+
+    def _post_save(self):
+        if self._cache:
+            self._cache.invalidate(getattr(self, self._row_key[0]))
+        super(RowModel, self)._post_save()
+
+    def _post_write(self):
+        # A get() made before the queued save was written may have cached the old row
+        cls, key = type(self), getattr(self, self._row_key[0])
+        def invalidate():
+            if cls._cache:
+                cls._cache.invalidate(key)
+        return invalidate
     
     @inlineCallbacks
     def delete(self, configuration=Configuration):
@@ -56,7 +182,14 @@ class RowModel(BaseModel):
             returnValue(False)
             yield
         else:
-            yield configuration.cassandra_client.remove(getattr(self, self._row_key[0]).bytes, self.Meta.column_family)
+            if self._uses_write_behind(configuration):
+                # A queued save is stamped when it is flushed, so it would outlive the delete
+                row_key = self._attributes[self._row_key[0]].to_db_value(getattr(self, self._row_key[0]))
+                write_behind_buffer(configuration).discard(row_key, self.Meta.column_family)
+            yield configuration.cassandra_client.batch_mutate(self._mutation_map_for_delete())
+            self._saved = None
+            if self._cache:
+                self._cache.invalidate(getattr(self, self._row_key[0]))
             self._setattr(self._row_key[0], None, filter=False)
             self._setattr('date_modified', None, filter=False)
             self._setattr('date_created', None, filter=False)
@@ -80,96 +213,542 @@ class RowModel(BaseModel):
     @classmethod
     def _result_to_instance(cls, key, result):
         o = cls(is_new=False)
-        o._setattr(o._row_key[0], key, filter=False)
-        for column in result:
-            o._setattr_from_db(column.column.name, column.column.value)
+        o._load_key(cls._row_key[0], key)
+        o._load_from_db(result)
         return o
         
     @classmethod
-    def _result_to_dict(cls, key, result):
-        columns = {cls._row_key[0]: key}
+    def _projection_type(cls, names):
+        """Returns the namedtuple used for rows projected onto names; the row key is always the first field."""
+        fields = (cls._row_key[0],) + tuple(k for k in names if k != cls._row_key[0])
+        row_type = cls._projection_types.get(fields)
+        if row_type is None:
+            for k in fields:
+                if k not in cls._attributes: raise Exception('Unknown attribute: %s' % k)
+            row_type = cls._projection_types[fields] = namedtuple('%sRow' % cls.__name__, fields)
+        return row_type
+
+    @classmethod
+    def _result_to_row(cls, row_type, key, result):
+        values = dict.fromkeys(row_type._fields)
+        values[cls._row_key[0]] = key
         for column in result:
-            attribute_name = column.column.name
-            p = cls._attributes[attribute_name] if attribute_name in cls._attributes else None
-            if p is None: raise Exception('Unknown attribute: %s' % attribute_name)
-            value = column.column.value
-            columns[attribute_name] = p.from_db_value(value)
-        return columns
-        
+            name = column.column.name
+            if name in values:
+                values[name] = cls._attributes[name].from_db_value(column.column.value)
+        return row_type(**values)
+
     @classmethod
-    @inlineCallbacks
     def get(cls, key, configuration=Configuration):
 #         assert(isinstance(key, uuid.UUID))
         #TODO assert key is same type as row_key attribute / support not UUID key
-        names = cls._attributes.keys()
-        record = yield configuration.cassandra_client.get_slice(key.bytes, cls.Meta.column_family, names=names)
-        if record == []:
-            returnValue(None)
+        cache = cls._read_cache(configuration)
+        if cache is not None:
+            record = cache.get(key, _not_cached)
+            if record is not _not_cached:
+                return defer.succeed(cls._record_to_instance(record, key))
+            version = cache.version
+
+        if configuration.coalesce_gets:
+            # Merge with the other gets made in this reactor turn into one multiget_slice
+            loader = cls._loaders.get(configuration)
+            if loader is None:
+                loader = cls._loaders[configuration] = BatchLoader(lambda keys: cls._multiget_records(keys, configuration=configuration))
+            d = loader.load(key)
+        else:
+            names = cls._attributes.keys()
+            d = configuration.cassandra_client.get_slice(key.bytes, cls.Meta.column_family, names=names)
+        if cache is not None:
+            d.addCallback(cls._fill_cache, cache, key, version)
+        d.addCallback(cls._record_to_instance, key)
+        return d
+
+    @classmethod
+    def _read_cache(cls, configuration):
+        """Returns the model's LRUCache, creating it on first use, or None when caching is disabled."""
+        if cls._cache is None:
+            size = getattr(cls.Meta, 'cache_size', configuration.cache_size)
+            ttl = getattr(cls.Meta, 'cache_ttl', configuration.cache_ttl)
+            negative_ttl = getattr(cls.Meta, 'cache_negative_ttl', configuration.cache_negative_ttl)
+            cls._cache = LRUCache(size, ttl, negative_ttl) if size else False
+        return cls._cache or None
+
+    @classmethod
+    def _fill_cache(cls, record, cache, key, version):
+        cache.set(key, record or None, version)
+        return record
+
+    @classmethod
+    def cache_stats(cls):
+        """Returns the hit/miss/eviction counters of the model's read cache, or None when it is disabled."""
+        return cls._cache.stats() if cls._cache else None
+
+    @classmethod
+    def _record_to_instance(cls, record, key):
+        if not record:
+            return None
         o = cls._result_to_instance(key, record)
         o._post_get()
-        returnValue(o)
+        return o
+
+    @classmethod
+    @inlineCallbacks
+    def get_many(cls, keys, chunk_size=None, concurrency=None, configuration=Configuration):
+        """
+        Fetches the rows for keys with chunked, concurrent multiget_slice calls.
+        Returns a list of instances in the order of keys, with None for missing rows.
+        """
+        records = yield cls._multiget_records(keys, chunk_size, concurrency, configuration)
+        returnValue([cls._record_to_instance(records.get(key), key) for key in keys])
+
+    @classmethod
+    @inlineCallbacks
+    def _multiget_records(cls, keys, chunk_size=None, concurrency=None, configuration=Configuration):
+        """Returns a dict of key -> list of columns for the unique keys, chunk_size keys per multiget_slice."""
+        chunk_size = chunk_size or configuration.multiget_chunk_size
+        semaphore = defer.DeferredSemaphore(concurrency or configuration.multiget_concurrency)
+        names = cls._attributes.keys()
+        
+        unique_keys = list(set(keys))
+        requests = []
+        for i in range(0, len(unique_keys), chunk_size):
+            chunk = dict((key.bytes, key) for key in unique_keys[i:i+chunk_size])
+            d = semaphore.run(configuration.cassandra_client.multiget_slice, chunk.keys(), cls.Meta.column_family, names=names)
+            d.addCallback(lambda result, chunk=chunk: [(chunk[k], columns) for k, columns in result.items()])
+            requests.append(d)
+        
+        chunks = yield _gather(requests)
+        returnValue(dict(record for chunk in chunks for record in chunk))
+
+
+    @classmethod
+    @inlineCallbacks
+    def _plan_query(cls, expressions, configuration=Configuration):
+        """
+        Returns the QueryPlan for a list of expressions. When the planner has to choose between
+        indexed EQ expressions it has no statistics for, it first reads up to
+        planner_sample_size matching keys for each of them.
+        """
+        unknown = cls._planner.unknown(expressions)
+        samples = {}
+        if unknown:
+            size = configuration.planner_sample_size
+            pages = [cls._indexed_slice_pages([e], names=[e.column_name], page_size=size, read_ahead=False, configuration=configuration).next_page() for e in unknown]
+            results = yield _gather(pages)
+            for e, rows in zip(unknown, results):
+                samples[e.column_name] = len(rows)
+                cls._planner.record(e.column_name, len(rows))
+        returnValue(cls._planner.plan(expressions, samples))
+
+    @classmethod
+    def _indexed_slice_pages(cls, expressions, names=None, page_size=None, hydrate=None, read_ahead=True, configuration=Configuration):
+        """Returns a QueryIterator over the raw KeySlices matching expressions, page_size rows at a time."""
+        def fetch(start_key, count):
+            return configuration.cassandra_client.get_indexed_slices(cls.Meta.column_family, expressions, names=names, start_key=start_key, count=count, column_count=configuration.column_count)
+        return QueryIterator(fetch, page_size or configuration.count, hydrate=hydrate, read_ahead=read_ahead)
+
+    @classmethod
+    def iterate_query(cls, query=None, page_size=100, configuration=Configuration):
+        """Streams the matches of query as pages of hydrated instances (or projected rows).
+
+        Rows come back in index order: sorts, offset and limit are not applied.
+        The driving expression is chosen from the planner's statistics alone.
+        """
+        if query is None:
+            raise Exception('query is None!')
+
+        plan = cls._planner.plan(cls._single_branch(query, 'iterate()'))
+        projection = query._projection()
+        names = None
+        if projection is not None:
+            row_type = cls._projection_type(projection)
+            names = list(set(row_type._fields[1:]) | set(plan.columns))
+
+        def hydrate(rows):
+            instances = []
+            for r, columns in plan.filter(rows):
+                if projection is not None:
+                    instances.append(cls._result_to_row(row_type, uuid.UUID(bytes=r.key), r.columns))
+                    continue
+                o = cls._result_to_instance(uuid.UUID(bytes=r.key), r.columns)
+                o._post_get()
+                instances.append(o)
+            plan.rows_returned += len(instances)
+            return instances
+
+        return cls._indexed_slice_pages([plan.driver], names=names, page_size=page_size, hydrate=hydrate, configuration=configuration)
+
+    @classmethod
+    def _counting_sort_index(cls, plan):
+        """Returns (row, column family) of a sort index row holding one column per match, if there is one."""
+        if not plan.filters:
+            for (primary, secondary), index_cf in sorted(cls._sort_indexes.items()):
+                if primary == plan.driver.column_name:
+                    return plan.driver.value, index_cf
+        return None
+
+    @classmethod
+    def _counting_columns(cls, plan):
+        """
+        The filtered columns are all that is needed to count matches; without
+        filters, ask for the (small) column of the driving expression, which
+        every match has.
+        """
+        return plan.columns or [plan.driver.column_name]
+
+    @classmethod
+    @inlineCallbacks
+    def count_query(cls, query=None, page_size=None, configuration=Configuration):
+        """
+        Counts the matches of query without fetching whole rows, hydrating or
+        sorting them. The branches of an IN/OR query are counted concurrently.
+        """
+        if query is None:
+            raise Exception('query is None!')
+
+        branches, disjoint = query._branches()
+        plans = yield _gather([cls._plan_query(b, configuration) for b in branches])
+        if disjoint:
+            counts = yield _gather([cls._count_plan(plan, page_size, configuration) for plan in plans])
+            returnValue(sum(counts))
+        # Rows can match several branches, so count their distinct keys
+        keys = yield _gather([cls._count_plan(plan, page_size, configuration, keys=set()) for plan in plans])
+        returnValue(len(set().union(*keys)))
+
+    @classmethod
+    @inlineCallbacks
+    def _count_plan(cls, plan, page_size=None, configuration=Configuration, keys=None):
+        """Returns the number of matches of plan, or when given a set, that set with their keys added."""
+        index_row = cls._counting_sort_index(plan)
+        if index_row is not None and keys is None:
+            total = yield configuration.cassandra_client.get_count(*index_row)
+            returnValue(total)
 
+        total = 0
+        for page in cls._indexed_slice_pages([plan.driver], names=cls._counting_columns(plan), page_size=page_size, configuration=configuration):
+            rows = yield page
+            matched = plan.filter(rows)
+            total += len(matched)
+            if keys is not None:
+                keys.update(r.key for r, columns in matched)
+        cls._planner.record(plan.driver.column_name, plan.rows_scanned)
+        returnValue(total if keys is None else keys)
+
+    @classmethod
+    @inlineCallbacks
+    def estimate_query(cls, query=None, sample_size=None, configuration=Configuration):
+        """Returns a TotalEstimate of the number of matches of query after scanning at most sample_size rows."""
+        if query is None:
+            raise Exception('query is None!')
+
+        plan = yield cls._plan_query(cls._single_branch(query, 'estimate()'), configuration)
+
+        index_row = cls._counting_sort_index(plan)
+        if index_row is not None:
+            total = yield configuration.cassandra_client.get_count(*index_row)
+            returnValue(TotalEstimate(total))
+
+        keys, estimate = yield cls._sample_matches(plan, 0, sample_size, configuration)
+        returnValue(estimate)
+
+    @classmethod
+    @inlineCallbacks
+    def _sample_matches(cls, plan, needed=0, sample_size=None, configuration=Configuration):
+        """
+        Scans matches in token order until at least sample_size rows have been
+        read and the first needed matches are known. Returns those keys and a
+        TotalEstimate of all matches.
+
+        get_indexed_slices returns rows in token order and the RandomPartitioner
+        spreads keys uniformly over the token ring, so the matches seen make up
+        about token(last row seen) / TOKEN_RING_SIZE of the total.
+        """
+        sample_size = sample_size or configuration.estimate_sample_size
+        keys = []
+        matched = 0
+        last_key = None
+        # The scan stops early, so a page read ahead would usually be wasted
+        pages = cls._indexed_slice_pages([plan.driver], names=cls._counting_columns(plan), page_size=max(sample_size, needed), read_ahead=False, configuration=configuration)
+        for page in pages:
+            rows = yield page
+            if rows:
+                last_key = rows[-1].key
+            for r, columns in plan.filter(rows):
+                matched += 1
+                if len(keys) < needed:
+                    keys.append(r.key)
+            if plan.rows_scanned >= sample_size and len(keys) >= needed:
+                break
+
+        if pages.exhausted or last_key is None:
+            cls._planner.record(plan.driver.column_name, plan.rows_scanned)
+            returnValue((keys, TotalEstimate(matched)))
+        covered = float(token(last_key) or 1) / TOKEN_RING_SIZE
+        total = int(round(matched / covered))
+        error = int(round(1.96 * math.sqrt(max(matched, 1)) / covered))
+        returnValue((keys, TotalEstimate(total, error, exact=False)))
 
     @classmethod
     @inlineCallbacks
 #     def filter(cls, filters=None, sorts=None, page=None, limit=None, configuration=Configuration):
-    def execute_query(cls, query=None, configuration=Configuration):
+    def execute_query(cls, query=None, approximate_total=False, configuration=Configuration):
+        """
+        Runs query and returns a QueryResult with one page of results.
+
+        With approximate_total and no explicit sort, the page is taken in index
+        order from a bounded scan and the total is estimated from it (see
+        estimate_query), so the cost no longer grows with the number of matches.
+        """
         if query is None:
             raise Exception('query is None!')
-            
+
+        branches, disjoint = query._branches()
+        if len(branches) != 1:
+            results = yield cls._execute_branches(query, branches, disjoint, configuration)
+            returnValue(results)
+        plan = yield cls._plan_query(branches[0], configuration)
+        results = yield cls._execute_plan(query, plan, approximate_total, configuration)
+        returnValue(results)
+
+    @classmethod
+    @inlineCallbacks
+    def explain_query(cls, query=None, approximate_total=False, configuration=Configuration):
+        """Runs query like execute_query and returns its QueryPlan, with the rows scanned, returned and bytes decoded."""
+        if query is None:
+            raise Exception('query is None!')
+
+        plan = yield cls._plan_query(cls._single_branch(query, 'explain()'), configuration)
+        yield cls._execute_plan(query, plan, approximate_total, configuration)
+        returnValue(plan)
+
+    @classmethod
+    def _single_branch(cls, query, operation):
+        branches, disjoint = query._branches()
+        if len(branches) != 1:
+            raise Exception('IN/OR queries are not supported by %s.' % operation)
+        return branches[0]
+
+    @classmethod
+    def _parse_sort(cls, query):
+        """Returns the name of the attribute query is sorted on and whether the order is descending."""
         sorts = query._sorts or [cls._row_key[0]]
-        offset = query._offset or 0
-        limit = query._limit or 25
-        
-        # get from memcache
-        # if not gotten from memcache:
-        preliminary_columns = []
-        for x in sorts:
-            preliminary_columns.append(x.lstrip('+-'))
         if len(sorts) > 1:
             raise Exception("Multiple order clauses not supported.")
         order = sorts[0]
-        reverse_sort = order.startswith('-')
         order_key_name = order.lstrip('+-')
+        if order_key_name not in cls._attributes: raise Exception('Unknown attribute: %s' % order_key_name)
+        return order_key_name, order.startswith('-')
 
-        excludes = {}
-        for i, e in enumerate(query._expressions):
-            if e.op == IndexOperator.NE:
-                excludes[e.column_name] = e.value
-                preliminary_columns.append(e.column_name)
-                del query._expressions[i]
-                    
-        preliminary_results = yield configuration.cassandra_client.get_indexed_slices(cls.Meta.column_family, query._expressions, names=preliminary_columns, start_key='', count=configuration.count, column_count=configuration.column_count)
-        
-        preliminary_results = [cls._result_to_dict(r.key, r.columns) for r in preliminary_results]
-        
-        def check_excludes(cols):
-            for k, v in excludes.items():
-                p = cls._attributes[k] if k in cls._attributes else None
-                if p is None: raise Exception('Unknown attribute: %s' % k)
-                attr = cols[k] if k in cols else None
-                if attr is not None and cols[k] == v:
-                    return False
-            return True
-            
-        matching_results = filter(check_excludes, preliminary_results)
-                             
-        sorted_matching_results = sorted(matching_results, key=itemgetter(order_key_name))
-        matching_keys = [r[cls._row_key[0]] for r in sorted_matching_results]
-        l = len(matching_keys)
-       
-        fetch_keys = matching_keys[offset:offset+limit] if not reverse_sort else matching_keys[l-offset-1:l-offset-limit-1:-1]        
-        search_results = yield configuration.cassandra_client.multiget_slice(fetch_keys, cls.Meta.column_family, count=limit)
+    @classmethod
+    @inlineCallbacks
+    def _execute_plan(cls, query, plan, approximate_total=False, configuration=Configuration):
+        offset = query._offset or 0
+        limit = query._limit or 25
         
-        results = []
-        for (key, columns) in search_results.items():
-            results.append(cls._result_to_instance(uuid.UUID(bytes=key), columns))
+        # get from memcache
+        # if not gotten from memcache:
+        order_key_name, reverse_sort = cls._parse_sort(query)
+        after = cls._parse_cursor(order_key_name, query._after)
+        projection = query._projection()
 
-        sorted_results = sorted(results, key=attrgetter(order_key_name))
-        if reverse_sort:
-            sorted_results.reverse()
-        
-        returnValue(QueryResult(sorted_results, l))
+        if query._sorts and not plan.filters:
+            index_cf = cls._sort_indexes.get((plan.driver.column_name, order_key_name))
+            if index_cf is not None:
+                plan.sort_index = index_cf
+                results = yield cls._execute_sort_index_query(index_cf, plan.driver.value, offset, limit, reverse_sort, projection, plan, after, configuration)
+                returnValue(results)
+
+        # Sampled pages come in token order, which cursors cannot resume from
+        if approximate_total and not query._sorts and after is None:
+            keys, estimate = yield cls._sample_matches(plan, offset + limit, configuration=configuration)
+            results = yield cls._fetch_instances(keys[offset:], projection, plan, configuration)
+            returnValue(QueryResult(results, estimate.total, estimate.error))
+
+        top = yield cls._top_matches(plan, offset + limit, order_key_name, reverse_sort, after=after, configuration=configuration)
+        l = top.count
+
+        page = top.items()[offset:]
+        sorted_results = yield cls._fetch_instances([key for sort_key, key in page], projection, plan, configuration)
+        returnValue(QueryResult(sorted_results, l, next_cursor=cls._next_cursor(order_key_name, page, limit)))
+
+    @classmethod
+    def _cursor_column(cls, order_key_name, packed, key):
+        """Returns the position of a row, given its packed order_key_name value, as bytes that compare in that order, like a sort index column name."""
+        return cls._attributes[order_key_name]._sort_format(packed) + key
+
+    @classmethod
+    def _next_cursor(cls, order_key_name, page, limit):
+        """Returns the cursor after the last of a full page of (sort key, row key) pairs, or None after a short page."""
+        if not page or len(page) < limit:
+            return None
+        sort_key, key = page[-1]
+        if not isinstance(sort_key, tuple):
+            # Already a sort index column name
+            return base64.urlsafe_b64encode(sort_key)
+        # The bytes as scanned: packing the decoded value again does not always give them back
+        return base64.urlsafe_b64encode(cls._cursor_column(order_key_name, sort_key[2], key))
+
+    @classmethod
+    def _parse_cursor(cls, order_key_name, cursor):
+        """Returns the Cursor for a QueryResult.next_cursor token, or None when there is no cursor."""
+        if cursor is None:
+            return None
+        try:
+            column = base64.urlsafe_b64decode(str(cursor))
+            key = column[-16:]
+            packed = cls._attributes[order_key_name]._sort_parse(column[:-16])
+            if order_key_name == cls._row_key[0] or packed is None:
+                value = packed
+            else:
+                value = cls._attributes[order_key_name].from_db_value(packed)
+        except (TypeError, ValueError, IndexError, struct.error):
+            raise Exception('Invalid cursor: %s' % cursor)
+        if len(key) != 16:
+            raise Exception('Invalid cursor: %s' % cursor)
+        return Cursor(column, (value, key))
+
+    @classmethod
+    @inlineCallbacks
+    def _top_matches(cls, plan, k, order_key_name, reverse_sort=False, keys=None, after=None, configuration=Configuration):
+        """
+        Scans every match of plan and returns a TopK of the first k as
+        ((sort value, row key, packed sort value), row key) pairs; ties are
+        broken by row key.
+        Only matches past the Cursor after are kept, but all of them count.
+        The keys of all matches are added to keys when it is given.
+        """
+        top = TopK(k, reverse=reverse_sort)
+        by_row_key = order_key_name == cls._row_key[0]
+        names = list(set(plan.columns) | set([] if by_row_key else [order_key_name]))
+        for page in cls._indexed_slice_pages([plan.driver], names=names, configuration=configuration):
+            rows = yield page
+            for r, columns in plan.filter(rows):
+                packed = r.key if by_row_key else columns.get(order_key_name)
+                value = r.key if by_row_key else plan.decode(order_key_name, packed)
+                if after is not None and not (after.position > (value, r.key) if reverse_sort else (value, r.key) > after.position):
+                    # Matches up to the cursor still count towards the total
+                    top.count += 1
+                else:
+                    top.push((value, r.key), ((value, r.key, packed), r.key))
+                if keys is not None:
+                    keys.add(r.key)
+        cls._planner.record(plan.driver.column_name, plan.rows_scanned)
+        returnValue(top)
+
+    @classmethod
+    @inlineCallbacks
+    def _execute_branches(cls, query, branches, disjoint, configuration=Configuration):
+        """
+        Runs an IN/OR query: every branch streams its matches concurrently and
+        the streams are merged in sort order, dropping keys already seen.
+
+        When the branches are disjoint and each one is a sort index row, the
+        rows are read lazily, so no branch is read beyond what the page needs.
+        Otherwise every branch is scanned into a TopK of offset+limit keys.
+        approximate_total does not apply to these queries.
+        """
+        offset = query._offset or 0
+        limit = query._limit or 25
+        order_key_name, reverse_sort = cls._parse_sort(query)
+        after = cls._parse_cursor(order_key_name, query._after)
+        projection = query._projection()
+        if not branches:
+            returnValue(QueryResult([], 0))
+
+        plans = yield _gather([cls._plan_query(b, configuration) for b in branches])
+        index_cfs = set(cls._sort_indexes.get((plan.driver.column_name, order_key_name)) for plan in plans)
+        if query._sorts and disjoint and None not in index_cfs and not any(plan.filters for plan in plans):
+            index_cf = index_cfs.pop()
+            totals = _gather([configuration.cassandra_client.get_count(plan.driver.value, index_cf) for plan in plans])
+            start = after.column if after is not None else ''
+            streams = [cls._sort_index_stream(index_cf, plan.driver.value, offset + limit, reverse_sort, start, configuration) for plan in plans]
+            merged = yield _merge_streams(streams, offset + limit, reverse_sort)
+            totals = yield totals
+            total = sum(totals)
+        else:
+            seen = None if disjoint else set()
+            tops = yield _gather([cls._top_matches(plan, offset + limit, order_key_name, reverse_sort, seen, after, configuration) for plan in plans])
+            streams = [_list_stream(top.items()) for top in tops]
+            merged = yield _merge_streams(streams, offset + limit, reverse_sort)
+            total = sum(top.count for top in tops) if disjoint else len(seen)
+
+        page = merged[offset:]
+        results = yield cls._fetch_instances([key for sort_key, key in page], projection, configuration=configuration)
+        returnValue(QueryResult(results, total, next_cursor=cls._next_cursor(order_key_name, page, limit)))
+
+    @classmethod
+    def _sort_index_stream(cls, index_cf, index_row, page_size, reverse_sort=False, start='', configuration=Configuration):
+        """
+        Returns a function that reads the next page_size columns of a sort
+        index row after the column start as (column name, row key) pairs; an
+        empty page means the row is exhausted.
+        """
+        state = {'start': start, 'exhausted': False}
+
+        def next_page():
+            if state['exhausted']:
+                return defer.succeed([])
+            start = state['start']
+            # start is inclusive, so ask for one extra column to replace the one already seen
+            count = page_size + 1 if start else page_size
+            d = configuration.cassandra_client.get_slice(index_row, index_cf, start=start, count=count, reverse=reverse_sort)
+
+            def received(columns):
+                if len(columns) < count:
+                    state['exhausted'] = True
+                if columns:
+                    state['start'] = columns[-1].column.name
+                # Index column names end with the 16 byte row key
+                return [(c.column.name, c.column.name[-16:]) for c in columns if not start or c.column.name != start]
+            return d.addCallback(received)
+        return next_page
+
+    @classmethod
+    @inlineCallbacks
+    def _execute_sort_index_query(cls, index_cf, index_row, offset, limit, reverse_sort, projection=None, plan=None, after=None, configuration=Configuration):
+        """
+        Reads a sorted page straight from a sort index row, so the cost depends
+        on offset+limit rather than on the number of matches. With a Cursor,
+        the slice starts at its column, so deep pages cost the same as the first.
+        """
+        total = configuration.cassandra_client.get_count(index_row, index_cf)
+        stream = cls._sort_index_stream(index_cf, index_row, offset + limit, reverse_sort, after.column if after is not None else '', configuration)
+        columns = yield stream()
+        if plan is not None:
+            plan.rows_scanned += len(columns)
+        page = columns[offset:]
+        results = yield cls._fetch_instances([key for column, key in page], projection, plan, configuration)
+        total = yield total
+        returnValue(QueryResult(results, total, next_cursor=cls._next_cursor(None, page, limit)))
+
+    @classmethod
+    @inlineCallbacks
+    def _fetch_instances(cls, keys, projection=None, plan=None, configuration=Configuration):
+        """
+        Fetches the rows for keys (packed row keys) in the order of keys: as
+        instances, or as read-only rows holding only the projected columns.
+        """
+        if not keys:
+            returnValue([])
+
+        if projection is not None:
+            row_type = cls._projection_type(projection)
+            names = list(row_type._fields[1:])
+            search_results = {}
+            if names:
+                search_results = yield configuration.cassandra_client.multiget_slice(keys, cls.Meta.column_family, names=names)
+            results = [cls._result_to_row(row_type, uuid.UUID(bytes=key), search_results.get(key, [])) for key in keys]
+        else:
+            search_results = yield configuration.cassandra_client.multiget_slice(keys, cls.Meta.column_family, count=configuration.column_count)
+            results = []
+            for key in keys:
+                if search_results.get(key):
+                    results.append(cls._result_to_instance(uuid.UUID(bytes=key), search_results[key]))
+
+        if plan is not None:
+            plan.rows_returned += len(results)
+            plan.bytes_decoded += sum(len(c.column.value) for columns in search_results.values() for c in columns)
+        returnValue(results)
 
     def as_dict(self, properties=None):
         if properties is None:
@@ -0,0 +1,124 @@
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from configuration import Configuration
+from utils import merge_mutation_maps
+
+
+class Session(object):
+    """Unit of work: instances saved through the session are recorded and
+    written together by flush().
+
+    session.save(instance) runs the instance's pre_save hooks on its first
+    save and records it; saving it again before the flush is a no-op, since
+    flush() writes whatever state it has by then. flush() merges the mutation
+    maps of every model, across column families, into one batch_mutate, or
+    into several of at most chunk_rows row keys each.
+
+    The session also keeps an identity map: session.get() of a key already
+    loaded or saved through the session returns that same instance, and
+    saving a different instance for that key fails.
+
+    Usage:
+        with Session() as session:
+            yield session.save(a)
+            b = yield session.get(Model, key)
+            yield session.save(b)
+        yield session.flush()
+
+    Only calls made on the session join it; a plain instance.save() writes
+    straight away. Leaving the with block by an exception discards the
+    recorded saves.
+    """
+    def __init__(self, chunk_rows=None, configuration=Configuration):
+        self.configuration = configuration
+        self.chunk_rows = chunk_rows or configuration.save_chunk_rows
+        self._identity_map = {}
+        self._pending = []
+        self._pending_ids = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # The unit of work failed, so none of it gets written
+            self.clear()
+        return False
+
+    def __contains__(self, instance):
+        return id(instance) in self._pending_ids
+
+    def save(self, instance):
+        """
+        Runs instance's pre_save hooks and required checks and records it to
+        be written by flush(). Returns a Deferred that fires with True.
+        """
+        if instance in self:
+            return defer.succeed(True)
+        d = defer.maybeDeferred(instance._prepare_save)
+        d.addCallback(lambda _: self.add(instance))
+        d.addCallback(lambda _: True)
+        return d
+
+    def get(self, cls, *key):
+        """
+        Returns a Deferred of the instance of cls for key: the one loaded or
+        saved through this session if any, else cls.get(*key) added to the
+        identity map.
+        """
+        identity_key = key if len(key) > 1 else key[0]
+        o = self._identity_map.get((cls, identity_key))
+        if o is not None:
+            return defer.succeed(o)
+        d = cls.get(*key, configuration=self.configuration)
+        d.addCallback(lambda o: o and self.register(o))
+        return d
+
+    def add(self, instance):
+        """
+        Records instance to be written by flush() and adds it to the identity
+        map. Fails when the session already holds another instance for the
+        same key, whose saves would otherwise be written alongside it.
+        """
+        key = (type(instance), instance._identity_key())
+        if self._identity_map.setdefault(key, instance) is not instance:
+            raise Exception('The session already has an instance of %s for %r; save that one.' % (key[0].__name__, key[1]))
+        if id(instance) not in self._pending_ids:
+            self._pending_ids.add(id(instance))
+            self._pending.append(instance)
+
+    def register(self, instance):
+        """Adds a loaded instance to the identity map; returns the session's instance for its key."""
+        return self._identity_map.setdefault((type(instance), instance._identity_key()), instance)
+
+    def clear(self):
+        """Forgets the recorded saves and the identity map."""
+        self._identity_map.clear()
+        self._pending = []
+        self._pending_ids.clear()
+
+    @inlineCallbacks
+    def flush(self):
+        """
+        Writes the recorded saves and runs their post_save hooks. Returns the
+        number of batch_mutate calls made. A failure stops the flush; chunks
+        already written stay written.
+        """
+        pending, self._pending = self._pending, []
+        self._pending_ids.clear()
+
+        mutation_map = {}
+        for instance in pending:
+            instance._check_required()
+            merge_mutation_maps(mutation_map, instance._mutation_map_for_save())
+
+        keys = list(mutation_map)
+        calls = 0
+        for i in range(0, len(keys), self.chunk_rows):
+            chunk = dict((key, mutation_map[key]) for key in keys[i:i + self.chunk_rows])
+            yield self.configuration.cassandra_client.batch_mutate(chunk)
+            calls += 1
+
+        for instance in pending:
+            yield instance._complete_save()
+        returnValue(calls)
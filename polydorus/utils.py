@@ -1,6 +1,11 @@
 from telephus.cassandra.ttypes import *
+from twisted.internet import defer
 import uuid
 import struct
+import heapq
+import time
+import hashlib
+import random
 
 validators = {
     unicode: 'UTF8Type',
@@ -33,12 +38,12 @@ def generate_cfdef(cls, keyspace):
         
         cf_defs.append(cf_def)
         
-#         for name, rich_attr in cls._rich_attributes.items():
-#             for primary, secondary in rich_attr.Meta.indices:
-#                 idx_part = '%s_and_%s' % (primary, secondary)
-#                 cf_name = '%s_by_%s' % (rich_attr.Meta.base_name, idx_part)
-#                 cf_defs.append(CfDef(keyspace=keyspace, name=cf_name))
-#                 
+        for cf_name in sorted(getattr(cls, '_sort_indexes', {}).values()):
+            index_cf_def = CfDef(keyspace=keyspace, name=cf_name, comparator_type='BytesType')
+            index_cf_def.memtable_throughput_in_mb = cf_def.memtable_throughput_in_mb
+            index_cf_def.memtable_flush_after_mins = cf_def.memtable_flush_after_mins
+            index_cf_def.memtable_operations_in_millions = cf_def.memtable_operations_in_millions
+            cf_defs.append(index_cf_def)
         return cf_defs
 
 def generate_cfdef_cli(classes, keyspace, rf=1, 
@@ -52,7 +57,7 @@ def generate_cfdef_cli(classes, keyspace, rf=1,
     :param stategy: Name of the replica placement strategy to use. 
     """
 
-    cf_defs = [generate_cfdef(c, keyspace)[0] for c in classes]
+    cf_defs = [cf_def for c in classes for cf_def in generate_cfdef(c, keyspace)]
 
     buffer = []
     write = buffer.append
@@ -91,6 +96,108 @@ def generate_cfdef_cli(classes, keyspace, rf=1,
         write(";\n\n")
     return "".join(buffer)
     
+# Tokens of the RandomPartitioner lie in [0, 2**127]
+TOKEN_RING_SIZE = 2 ** 127
+
+def token(key):
+    """Returns the RandomPartitioner token of a row key: the absolute value of its md5 read as a signed 128 bit integer."""
+    n = long(hashlib.md5(key).hexdigest(), 16)
+    if n >= 1 << 127:
+        n -= 1 << 128
+    return abs(n)
+
+def _gather(deferreds):
+    """Returns a Deferred firing with the results of deferreds in order, or with the first failure."""
+    d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallback(lambda results: [result for success, result in results])
+    d.addErrback(lambda f: f.value.subFailure)
+    return d
+
+# 100ns intervals between the UUID epoch (1582-10-15) and the Unix epoch
+UUID_EPOCH = 0x01b21dd213814000
+_uuid_clock_seq = random.getrandbits(14)
+_uuid_node = None
+_last_uuid_time = 0
+
+def time_uuid():
+    """
+    Returns a new version 1 (time) UUID, like uuid.uuid1() but several
+    times faster: it skips the ctypes call into libuuid. Timestamps
+    increase strictly within the process, and the random clock sequence
+    keeps processes on one host apart.
+    """
+    global _uuid_node, _last_uuid_time
+    if _uuid_node is None:
+        _uuid_node = uuid.getnode()
+    t = int(time.time() * 10000000) + UUID_EPOCH
+    if t <= _last_uuid_time:
+        t = _last_uuid_time + 1
+    _last_uuid_time = t
+    return uuid.UUID(int=(t & 0xffffffff) << 96 | (t >> 32 & 0xffff) << 80 | (t >> 48 & 0x0fff | 0x1000) << 64
+        | (_uuid_clock_seq >> 8 | 0x80) << 56 | (_uuid_clock_seq & 0xff) << 48 | _uuid_node)
+
+def timestamp():
+    """Returns a Cassandra column timestamp (microseconds since the epoch)."""
+    return long(time.time() * 1000000)
+
+def merge_mutation_maps(target, source):
+    """
+    Merges the batch_mutate mutation map source into target and returns
+    target. Column families given as dicts of column values are merged with
+    source's values winning; when either side is a list of mutations, the
+    two are merged into a list that keeps, for each column name, only the
+    newest Column or Deletion of it.
+    """
+    for key, cfs in source.items():
+        target_cfs = target.setdefault(key, {})
+        for cf_name, mutations in cfs.items():
+            existing = target_cfs.get(cf_name)
+            if existing is None:
+                target_cfs[cf_name] = dict(mutations) if isinstance(mutations, dict) else list(mutations)
+            elif isinstance(existing, dict) and isinstance(mutations, dict):
+                existing.update(mutations)
+            else:
+                target_cfs[cf_name] = _collapse_mutations(_mutation_list(existing) + _mutation_list(mutations))
+    return target
+
+def _collapse_mutations(mutations):
+    """
+    Returns mutations with only the newest Column or column_names Deletion
+    of each column name, later ones winning ties. The deleted names go in
+    one Deletion at the newest of their timestamps. Row and SliceRange
+    Deletions are kept as they are.
+    """
+    latest = {}
+    result = []
+    for mutation in mutations:
+        if isinstance(mutation, Column):
+            names = [mutation.name]
+        elif mutation.predicate is not None and mutation.predicate.column_names is not None:
+            names = mutation.predicate.column_names
+        else:
+            result.append(mutation)
+            continue
+        for name in names:
+            current = latest.get(name)
+            if current is None or mutation.timestamp >= current.timestamp:
+                latest[name] = mutation
+    deleted, ts = [], None
+    for name, mutation in latest.items():
+        if isinstance(mutation, Column):
+            result.append(mutation)
+        else:
+            deleted.append(name)
+            ts = max(ts, mutation.timestamp)
+    if deleted:
+        result.append(Deletion(timestamp=ts, predicate=SlicePredicate(column_names=deleted)))
+    return result
+
+def _mutation_list(mutations, ts=None):
+    if isinstance(mutations, dict):
+        ts = ts or timestamp()
+        return [Column(name=name, value=value, timestamp=ts) for name, value in mutations.items()]
+    return list(mutations)
+
 def pack(value, data_type):
     """
     Packs a value into the expected sequence of bytes that Cassandra expects.
@@ -130,3 +237,92 @@ def unpack(b, data_type):
     else: # BytesType
         return b      
         
+
+
+_long_struct = struct.Struct('>q')
+_int_struct = struct.Struct('>i')
+
+def _encode_long(value, _pack=_long_struct.pack):
+    return _pack(long(value))
+
+def _decode_long(b, _unpack=_long_struct.unpack):
+    return _unpack(b)[0]
+
+def _encode_int(value, _pack=_int_struct.pack):
+    return _pack(int(value))
+
+def _decode_int(b, _unpack=_int_struct.unpack):
+    return _unpack(b)[0]
+
+def _encode_str(value):
+    return value if type(value) is str else str(value)
+
+def _decode_bytes(b):
+    return b
+
+def _encode_unicode(value):
+    try:
+        return value.encode('utf-8')
+    except UnicodeDecodeError:
+        return value
+
+def _decode_unicode(b):
+    return b.decode('utf-8')
+
+_codecs = {
+    long: (_encode_long, _decode_long),
+    int: (_encode_int, _decode_int),
+    str: (_encode_str, _decode_bytes),
+    unicode: (_encode_unicode, _decode_unicode),
+}
+
+def codec_for(data_type):
+    """
+    Returns the precompiled (encode, decode) pair for a data_type. They
+    produce the same bytes as pack and unpack without re-dispatching on the
+    type or building a struct format for every value.
+    """
+    if data_type in _codecs:
+        return _codecs[data_type]
+    return (lambda value: pack(value, data_type), lambda b: unpack(b, data_type))
+
+
+class _Inverted(object):
+    """Wraps a value so that it orders in reverse, turning heapq's min-heap into a max-heap."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class TopK(object):
+    """
+    Keeps the k items with the smallest sort keys (the largest ones when
+    reverse is set) out of everything pushed into it, in O(k) memory and
+    O(log k) per push. Sort keys must be unique, e.g. (value, row_key).
+    """
+    def __init__(self, k, reverse=False):
+        self.k = k
+        self.reverse = reverse
+        self.count = 0
+        self._heap = []
+
+    def push(self, sort_key, item):
+        self.count += 1
+        if self.k <= 0:
+            return
+        entry = (sort_key, item) if self.reverse else (_Inverted(sort_key), item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif self._heap[0] < entry:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """Returns the retained items, best first."""
+        return [item for sort_key, item in sorted(self._heap, reverse=True)]
@@ -0,0 +1,146 @@
+import logging
+from telephus.cassandra.ttypes import Column, InvalidRequestException
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from configuration import Configuration
+from utils import merge_mutation_maps, timestamp, _mutation_list
+
+
+class WriteBehindBuffer(object):
+    """
+    Queues mutation maps per row key and writes them later, so a row saved
+    many times between flushes costs one mutation: a later write of a column
+    replaces the queued one.
+
+    The buffer flushes interval seconds after its first queued write, or as
+    soon as it holds max_rows row keys. Reads do not see queued writes
+    until they have been flushed. The callback given with a write runs once
+    the flush that carries it has succeeded.
+
+    Flush failures of the timer are logged; flush() and drain() fail with them.
+    The writes of a batch_mutate that failed are queued again, under any newer
+    writes, and retried interval seconds later; writes Cassandra rejects as
+    invalid are dropped, since they would fail again.
+    To write everything out on shutdown:
+        reactor.addSystemEventTrigger('before', 'shutdown', buffer.drain)
+    """
+    def __init__(self, client, interval=1.0, max_rows=1000, chunk_rows=200, concurrency=4, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.client = client
+        self.interval = interval
+        self.max_rows = max_rows
+        self.chunk_rows = chunk_rows
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._clock = clock
+        self._mutation_map = {}
+        self._callbacks = []
+        self._call = None
+        self._in_flight = []
+
+    def __len__(self):
+        """Number of row keys waiting to be written."""
+        return len(self._mutation_map)
+
+    def add(self, mutation_map, callback=None):
+        merge_mutation_maps(self._mutation_map, mutation_map)
+        if callback is not None:
+            self._callbacks.append(callback)
+        if len(self._mutation_map) >= self.max_rows:
+            self._flush_logged()
+        elif self._call is None:
+            self._call = self._clock.callLater(self.interval, self._flush_logged)
+
+    def discard(self, row_key, column_family, names=None):
+        """
+        Drops the queued writes to row_key in column_family, or only those to
+        the given column names. Deletes call it so that a save queued before
+        them does not bring the data back when it is flushed.
+        """
+        cfs = self._mutation_map.get(row_key)
+        if cfs is None or column_family not in cfs:
+            return
+        if names is None:
+            del cfs[column_family]
+        else:
+            names = set(names)
+            mutations = cfs[column_family]
+            if isinstance(mutations, dict):
+                for name in names:
+                    mutations.pop(name, None)
+            else:
+                mutations[:] = [m for m in mutations if not (isinstance(m, Column) and m.name in names)]
+            if not mutations:
+                del cfs[column_family]
+        if not cfs:
+            del self._mutation_map[row_key]
+
+    def _flush_logged(self):
+        self.flush().addErrback(lambda f: logging.error('Write-behind flush failed: %s' % f.getTraceback()))
+
+    def flush(self):
+        """Writes the queued mutations; the Deferred fires once they are written."""
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        mutation_map, self._mutation_map = self._mutation_map, {}
+        callbacks, self._callbacks = self._callbacks, []
+        if not mutation_map:
+            for callback in callbacks:
+                callback()
+            return defer.succeed(None)
+
+        # Requeued writes keep the time of this attempt, so a delete made meanwhile still wins
+        ts = timestamp()
+        keys = list(mutation_map)
+        chunks = [dict((key, mutation_map[key]) for key in keys[i:i + self.chunk_rows]) for i in range(0, len(keys), self.chunk_rows)]
+        d = defer.DeferredList([self._semaphore.run(self.client.batch_mutate, chunk).addErrback(self._requeue, chunk, ts) for chunk in chunks],
+            fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+
+        def written(_):
+            for callback in callbacks:
+                callback()
+        def failed(failure):
+            self._callbacks[:0] = callbacks
+            return failure
+        d.addCallbacks(written, failed)
+        self._in_flight.append(d)
+
+        def done(result):
+            self._in_flight.remove(d)
+            return result
+        return d.addBoth(done)
+
+    def _requeue(self, failure, chunk, ts):
+        if not failure.check(InvalidRequestException):
+            stamped = dict((key, dict((cf_name, _mutation_list(mutations, ts)) for cf_name, mutations in cfs.items())) for key, cfs in chunk.items())
+            self._mutation_map = merge_mutation_maps(stamped, self._mutation_map)
+            if self._call is None:
+                self._call = self._clock.callLater(self.interval, self._flush_logged)
+        return failure
+
+    @inlineCallbacks
+    def drain(self):
+        """Flushes the queue and waits for every flush still in flight, e.g. before shutting down."""
+        yield self.flush()
+        while self._in_flight:
+            yield defer.DeferredList(list(self._in_flight), consumeErrors=True)
+        returnValue(None)
+
+
+_buffers = {}
+
+def write_behind_buffer(configuration=Configuration):
+    """
+    Returns the WriteBehindBuffer that save() uses for models in write-behind
+    mode, built from configuration's write_behind_* settings on first use.
+    """
+    key = (configuration, configuration.cassandra_client)
+    buffer = _buffers.get(key)
+    if buffer is None:
+        buffer = _buffers[key] = WriteBehindBuffer(configuration.cassandra_client,
+            configuration.write_behind_interval, configuration.write_behind_max_rows,
+            configuration.save_chunk_rows, configuration.save_concurrency)
+    return buffer
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from twisted.trial import unittest
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, task
 from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
 from twisted.internet.protocol import ClientCreator
 import decimal
@@ -11,13 +11,14 @@ from dateutil import parser
 import uuid
 import time
 import random
+import os
 from telephus.protocol import ManagedCassandraClientFactory, ManagedThriftClientProtocol
 from telephus.cassandra.ttypes import *
 from telephus.client import CassandraClient
 
-from polydorus import RowModel, ColumnModel
+from polydorus import RowModel, ColumnModel, Session, WriteBehindBuffer, write_behind_buffer
 from polydorus.attributes import *
-from polydorus.utils import generate_cfdef, generate_cfdef_cli
+from polydorus.utils import generate_cfdef, generate_cfdef_cli, UUID_EPOCH
 from polydorus.configuration import Configuration
 
 
@@ -53,6 +54,56 @@ class TestColumnModel(ColumnModel):
     int_test = IntegerAttribute()
     long_test = LongAttribute()
     
+
+class TestTaggedColumnModel(ColumnModel):
+    """TestColumnModel's column family, with compact column names."""
+    class Meta(ColumnModel.Meta):
+        column_family = 'col_test'
+        column_tags = {'int_test': 1, 'long_test': 2}
+
+    test2_id = UUIDAttribute(row_key=True)
+    id = UUIDAttribute(column_key=True)
+    int_test = IntegerAttribute()
+    long_test = LongAttribute()
+
+class TestPackedColumnModel(ColumnModel):
+    """TestColumnModel's column family, one column per object."""
+    class Meta(ColumnModel.Meta):
+        column_family = 'col_test'
+        pack_attributes = True
+        column_tags = {'int_test': 1, 'long_test': 2}
+
+    test2_id = UUIDAttribute(row_key=True)
+    id = UUIDAttribute(column_key=True)
+    int_test = IntegerAttribute()
+    long_test = LongAttribute()
+
+class TestGrownPackedColumnModel(ColumnModel):
+    """TestPackedColumnModel with an attribute added."""
+    class Meta(ColumnModel.Meta):
+        column_family = 'col_test'
+        pack_attributes = True
+        column_tags = {'int_test': 1, 'long_test': 2, 'char_test': 3}
+
+    test2_id = UUIDAttribute(row_key=True)
+    id = UUIDAttribute(column_key=True)
+    char_test = StringAttribute()
+    int_test = IntegerAttribute()
+    long_test = LongAttribute()
+
+class TestSeriesModel(ColumnModel):
+    class Meta(ColumnModel.Meta):
+        column_family = 'series_test'
+        row_bucket = 'hour'
+
+    source = UUIDAttribute(row_key=True)
+    id = UUIDAttribute(column_key=True)
+    int_test = IntegerAttribute()
+
+def time_uuid(seconds, clock_seq=0):
+    """Returns a time UUID for a Unix time."""
+    t = int(seconds * 10000000) + UUID_EPOCH
+    return uuid.UUID(fields=(t & 0xffffffff, t >> 32 & 0xffff, t >> 48 & 0x0fff | 0x1000, 0x80 | clock_seq >> 8 & 0x3f, clock_seq & 0xff, 1), version=1)
                     
 class TestModel2(TestRowModel):
     class Meta:
@@ -62,6 +113,7 @@ class TestModel2(TestRowModel):
 class TestModel1(TestRowModel):
     class Meta:
         column_family = 'test1'
+        sort_indexes = [('last_name', 'int_test')]
         memtable_throughput_in_mb = 6
         memtable_flush_after = 7
         memtable_operations = 8
@@ -89,11 +141,36 @@ class TestModel1(TestRowModel):
     ip_test = IPAddressAttribute(indexed=True)
     json_test = JSONAttribute()
 
+class TestCachedModel(TestModel1):
+    class Meta:
+        column_family = 'test1'
+        cache_size = 10
+
+class TestLazyModel(TestModel1):
+    class Meta:
+        column_family = 'test1'
+        lazy_hydration = True
+
+class TestEventModel(RowModel):
+    """Sorted by a DateTimeAttribute, whose packed value only reads back exactly in UTC."""
+    class Meta:
+        column_family = 'events'
+        sort_indexes = [('group', 'when')]
+
+    id = UUIDAttribute(row_key=True)
+    group = StringAttribute(indexed=True)
+    kind = StringAttribute(indexed=True)
+    when = DateTimeAttribute(indexed=True)
+    n = IntegerAttribute()
+    note = StringAttribute()
+
 keyspace = 'PolydorusTrial'
 
 cf_defs = generate_cfdef(TestModel1, keyspace)
 cf_defs.extend(generate_cfdef(TestModel2, keyspace))
 cf_defs.extend(generate_cfdef(TestColumnModel, keyspace))
+cf_defs.extend(generate_cfdef(TestSeriesModel, keyspace))
+cf_defs.extend(generate_cfdef(TestEventModel, keyspace))
 keyspace_def = KsDef(name=keyspace, replication_factor=1, strategy_class='org.apache.cassandra.locator.SimpleStrategy', cf_defs=cf_defs)
 
 @inlineCallbacks
@@ -185,6 +262,10 @@ class ModelTest(unittest.TestCase):
         self.assertEqual(7, cf_def.memtable_flush_after_mins)
         self.assertEqual(8, cf_def.memtable_operations_in_millions)
 
+        index_cf_def = generate_cfdef(TestModel1, "Test")[1]
+        self.assertEqual('test1_by_last_name_and_int_test', index_cf_def.name)
+        self.assertEqual('BytesType', index_cf_def.comparator_type)
+
     def test_cli_script(self):
         script = generate_cfdef_cli([TestModel1, TestModel2], "Test")
         
@@ -378,4 +459,569 @@ class ModelTest(unittest.TestCase):
         for r in search_results:
             self.failUnless(r.int_test > 5)
             
-        
\ No newline at end of file
+        
+    @inlineCallbacks
+    def test_iterate(self):
+        for i in range(30):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        seen = []
+        for page in TestModel1.filter(TestModel1.last_name == 'Schmidt').filter(TestModel1.int_test != 5).iterate(page_size=7):
+            instances = yield page
+            self.failUnless(len(instances) <= 7)
+            seen.extend(r.int_test for r in instances)
+        self.failUnlessEquals(sorted(seen), [i for i in range(30) if i != 5])
+
+        # Asking for a page before the previous one arrived must not rescan from the start
+        pages = iter(TestModel1.filter(TestModel1.last_name == 'Schmidt').iterate(page_size=7))
+        first = pages.next()
+        self.assertRaises(Exception, pages.next)
+        instances = yield first
+        self.failUnlessEquals(len(instances), 7)
+
+    @inlineCallbacks
+    def test_sort_index(self):
+        for i in range(10):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        m = yield TestModel1.get(m.foo)
+        m.int_test = -1
+        yield m.save()
+
+        search_results = yield TestModel1.filter(TestModel1.last_name == 'Schmidt').sort('int_test').limit(3).execute()
+        self.failUnlessEquals(search_results.total, 10)
+        self.failUnlessEquals([r.int_test for r in search_results], [-1, 0, 1])
+
+        yield m.delete()
+        search_results = yield TestModel1.filter(TestModel1.last_name == 'Schmidt').sort('-int_test').limit(3).execute()
+        self.failUnlessEquals(search_results.total, 9)
+        self.failUnlessEquals([r.int_test for r in search_results], [8, 7, 6])
+
+    def test_sort_index_types(self):
+        def define(attribute):
+            class Indexed(RowModel):
+                class Meta:
+                    column_family = 'indexed'
+                    sort_indexes = [('name', 'value')]
+                id = UUIDAttribute(row_key=True)
+                name = StringAttribute()
+                value = attribute
+        define(DateTimeAttribute())
+        self.failUnlessRaises(Exception, define, IPAddressAttribute())
+        self.failUnlessRaises(Exception, define, JSONAttribute())
+
+    @inlineCallbacks
+    def test_get_many(self):
+        ids = []
+        for i in range(5):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+            ids.append(m.foo)
+        missing = uuid.uuid1()
+
+        results = yield TestModel1.get_many(ids + [missing, ids[0]], chunk_size=2)
+        self.failUnlessEquals([r.int_test for r in results[:5]], range(5))
+        self.failUnlessEquals(results[5], None)
+        self.failUnlessEquals(results[6].foo, ids[0])
+
+        results = yield defer.gatherResults([TestModel1.get(id) for id in ids + [missing, ids[0]]])
+        self.failUnlessEquals([r.int_test for r in results[:5]], range(5))
+        self.failUnlessEquals(results[5], None)
+        self.failIf(results[0] is results[6])
+
+    @inlineCallbacks
+    def test_cache(self):
+        m = TestCachedModel(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+        m.int_test = 1
+        yield m.save()
+
+        a = yield TestCachedModel.get(m.foo)
+        b = yield TestCachedModel.get(m.foo)
+        self.failIf(a is b)
+        self.failUnlessEquals(b.int_test, 1)
+        self.failUnlessEquals(TestCachedModel.cache_stats()['hits'], 1)
+
+        b.int_test = 2
+        yield b.save()
+        c = yield TestCachedModel.get(m.foo)
+        self.failUnlessEquals(c.int_test, 2)
+
+        yield c.delete()
+        c = yield TestCachedModel.get(m.foo)
+        self.failUnlessEquals(c, None)
+
+    @inlineCallbacks
+    def test_lazy_hydration(self):
+        json_bit = 1 << TestLazyModel._attribute_index['json_test']
+        i = yield TestLazyModel.get(self.test1_id)
+        self.failUnless(i._undecoded & json_bit)
+        self.failUnlessEquals(i.json_test, {'a':1, 'b':[1,2,3]})
+        self.failIf(i._undecoded & json_bit)
+        self.failUnlessEquals(i.as_dict()['first_name'], u'Матфей')
+
+        i.last_name = u'Иона'
+        yield i.save()
+        i = yield TestModel1.get(self.test1_id)
+        self.failUnlessEquals(i.last_name, u'Иона')
+        self.failUnlessEquals(i.json_test, {'a':1, 'b':[1,2,3]})
+
+    @inlineCallbacks
+    def test_projection(self):
+        for i in range(5):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        search_results = yield TestModel1.filter(TestModel1.first_name == 'Jane').sort('-int_test').attributes(['last_name', 'int_test']).limit(2).execute()
+        self.failUnlessEquals(search_results.total, 5)
+        self.failUnlessEquals([(r.last_name, r.int_test) for r in search_results], [('Schmidt', 4), ('Schmidt', 3)])
+        self.failUnless(isinstance(search_results[0].foo, uuid.UUID))
+        self.failIf(hasattr(search_results[0], 'first_name'))
+
+    @inlineCallbacks
+    def test_count(self):
+        for i in range(10):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        total = yield TestModel1.filter(TestModel1.last_name == 'Schmidt').count()
+        self.failUnlessEquals(total, 10)
+        total = yield TestModel1.filter(TestModel1.first_name == 'Jane').filter(TestModel1.int_test != 5).count()
+        self.failUnlessEquals(total, 9)
+
+    @inlineCallbacks
+    def test_estimate(self):
+        for i in range(10):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        estimate = yield TestModel1.filter(TestModel1.first_name == 'Jane').estimate()
+        self.failUnless(estimate.exact)
+        self.failUnlessEquals(estimate.total, 10)
+
+        estimate = yield TestModel1.filter(TestModel1.first_name == 'Jane').estimate(sample_size=3)
+        self.failUnless(estimate.exact or estimate.error > 0)
+
+        search_results = yield TestModel1.filter(TestModel1.first_name == 'Jane').limit(4).execute(approximate_total=True)
+        self.failUnlessEquals(len(search_results), 4)
+        self.failUnlessEquals(search_results.total, 10)
+        self.failUnlessEquals(search_results.total_error, 0)
+
+    @inlineCallbacks
+    def test_explain(self):
+        for i in range(20):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt' if i < 18 else 'Rare')
+            m.int_test = i
+            m.write_once_test = i % 2
+            yield m.save()
+
+        query = lambda: TestModel1.filter(TestModel1.first_name == 'Jane').filter(TestModel1.last_name == 'Rare').filter(TestModel1.write_once_test == 1)
+        plan = yield query().explain()
+        self.failUnlessEquals(plan.driver.column_name, 'last_name')
+        self.failUnlessEquals(plan.rows_scanned, 2)
+        self.failUnlessEquals(plan.rows_returned, 1)
+        self.failUnless('Local filter' in str(plan))
+
+        search_results = yield query().execute()
+        self.failUnlessEquals([r.int_test for r in search_results], [19])
+
+    @inlineCallbacks
+    def test_in_query(self):
+        for i in range(12):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name=['Schmidt', 'Jacob', 'Smith'][i % 3])
+            m.int_test = i
+            yield m.save()
+
+        search_results = yield TestModel1.filter(TestModel1.last_name.in_(['Schmidt', 'Smith'])).sort('-int_test').limit(4).execute()
+        self.failUnlessEquals(search_results.total, 8)
+        self.failUnlessEquals([r.int_test for r in search_results], [11, 9, 8, 6])
+
+        query = TestModel1.filter(AnyOf(TestModel1.last_name == 'Jacob', TestModel1.int_test == 3)).sort('int_test')
+        search_results = yield query.execute()
+        self.failUnlessEquals([r.int_test for r in search_results], [1, 3, 4, 7, 10])
+        total = yield TestModel1.filter(AnyOf(TestModel1.last_name == 'Jacob', TestModel1.int_test == 4)).count()
+        self.failUnlessEquals(total, 4)
+
+    @inlineCallbacks
+    def test_cursor(self):
+        for i in range(10):
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt')
+            m.int_test = i
+            yield m.save()
+
+        for query in (lambda: TestModel1.filter(TestModel1.last_name == 'Schmidt').sort('-int_test'),
+                      lambda: TestModel1.filter(TestModel1.first_name == 'Jane').sort('-int_test')):
+            seen = []
+            cursor = None
+            while True:
+                q = query().limit(4)
+                if cursor is not None:
+                    q = q.after(cursor)
+                search_results = yield q.execute()
+                self.failUnlessEquals(search_results.total, 10)
+                seen.extend(r.int_test for r in search_results)
+                cursor = search_results.next_cursor
+                if cursor is None:
+                    break
+            self.failUnlessEquals(seen, range(9, -1, -1))
+
+    @inlineCallbacks
+    def test_cursor_inexact_sort(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            start = datetime.datetime(2020, 1, 1, tzinfo=utc)
+            for n in range(10):
+                yield TestEventModel(kind='k', when=start + datetime.timedelta(hours=n), n=n).save()
+
+            # No sort index on (kind, when), so the matches are scanned
+            seen = []
+            cursor = None
+            while True:
+                q = TestEventModel.filter(TestEventModel.kind == 'k').sort('when').limit(3)
+                if cursor is not None:
+                    q = q.after(cursor)
+                search_results = yield q.execute()
+                seen.extend(r.n for r in search_results)
+                cursor = search_results.next_cursor
+                if cursor is None:
+                    break
+            self.failUnlessEquals(seen, range(10))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    @inlineCallbacks
+    def test_save_many(self):
+        instances = [TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt', int_test=i) for i in range(10)]
+        instances.append(TestModel1(first_name='Jane'))
+        results = yield TestModel1.save_many(instances, chunk_rows=4)
+        self.failUnlessEquals(results[:10], [True] * 10)
+        self.failIf(results[10] is True)
+
+        search_results = yield TestModel1.filter(TestModel1.last_name == 'Schmidt').sort('int_test').execute()
+        self.failUnlessEquals([r.int_test for r in search_results], range(10))
+
+        # A second instance of the same row fails; the first keeps a true record of what it wrote
+        a = yield TestModel1.get(instances[0].foo)
+        b = yield TestModel1.get(instances[0].foo)
+        a.int_test = 20
+        b.first_name, b.int_test = 'Other', 30
+        results = yield TestModel1.save_many([a, b, a])
+        self.failUnlessEquals(results[0], True)
+        self.failIf(results[1] is True)
+        self.failUnlessEquals(results[2], True)
+        self.failUnlessEquals(a._saved_value('first_name'), 'Jane')
+        search_results = yield TestModel1.filter(TestModel1.last_name == 'Schmidt').sort('int_test').execute()
+        self.failUnlessEquals([r.int_test for r in search_results], range(1, 10) + [20])
+
+    @inlineCallbacks
+    def test_session(self):
+        with Session() as session:
+            m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt', int_test=1)
+            yield session.save(m)
+            m.int_test = 2
+            yield session.save(m)
+            c = TestColumnModel(test2_id=self.test2_id, id=uuid.uuid1(), int_test=3)
+            yield session.save(c)
+            i = yield session.get(TestModel1, m.foo)
+            self.failUnless(i is m)
+            i = yield session.get(TestColumnModel, self.test2_id, c.id)
+            self.failUnless(i is c)
+            # Another instance of a row the session holds is not saved alongside it
+            other = yield TestModel1.get(self.test1_id)
+            yield session.get(TestModel1, self.test1_id)
+            try:
+                yield session.save(other)
+                self.fail('saving a second instance of a row should fail')
+            except Exception, e:
+                self.failUnless('already has an instance' in str(e))
+            # Saves made outside the session are written straight away
+            o = TestModel2(name='Outside')
+            yield o.save()
+            i = yield TestModel2.get(o.foo)
+            self.failUnlessEquals(i.name, 'Outside')
+            self.failIf(o in session)
+
+        calls = yield session.flush()
+        self.failUnlessEquals(calls, 1)
+        i = yield TestModel1.get(m.foo)
+        self.failUnlessEquals(i.int_test, 2)
+        i = yield TestColumnModel.get(self.test2_id, c.id)
+        self.failUnlessEquals(i.int_test, 3)
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        m = TestModel2(name='Test')
+        yield m.save()
+
+        Configuration.write_behind = True
+        try:
+            for i in range(10):
+                m.name = 'Test %d' % i
+                yield m.save()
+            buffer = write_behind_buffer()
+            self.failUnlessEquals(len(buffer), 1)
+            yield buffer.drain()
+            self.failUnlessEquals(len(buffer), 0)
+        finally:
+            Configuration.write_behind = False
+
+        i = yield TestModel2.get(m.foo)
+        self.failUnlessEquals(i.name, 'Test 9')
+
+    @inlineCallbacks
+    def test_sort_index_unchanged_attribute(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            start = datetime.datetime(2020, 1, 1, tzinfo=utc)
+            ids = []
+            for n in range(5, 8):
+                e = TestEventModel(group='g', when=start + datetime.timedelta(hours=n), n=n)
+                yield e.save()
+                ids.append(e.id)
+            # Saving other attributes leaves the index entry where it is
+            for i in range(3):
+                e = yield TestEventModel.get(ids[0])
+                e.note = 'Note %d' % i
+                yield e.save()
+            results = yield TestEventModel.filter(TestEventModel.group == 'g').sort('when').execute()
+            self.failUnlessEquals([r.n for r in results], [5, 6, 7])
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    @inlineCallbacks
+    def test_write_behind_sort_index(self):
+        m = TestModel1(test2_id=self.test2_id, first_name='Jane', last_name='Queued', int_test=0)
+        yield m.save()
+
+        Configuration.write_behind = True
+        try:
+            for i in range(1, 50):
+                m.int_test = i
+                yield m.save()
+            buffer = write_behind_buffer()
+            # One Column and one Deletion for the index row, one write for the data row
+            queued = sum(len(mutations) for cfs in buffer._mutation_map.values() for mutations in cfs.values())
+            self.failUnlessEquals(queued, 3)
+            yield buffer.drain()
+        finally:
+            Configuration.write_behind = False
+
+        results = yield TestModel1.filter(TestModel1.last_name == 'Queued').sort('int_test').execute()
+        self.failUnlessEquals([r.int_test for r in results], [49])
+
+    @inlineCallbacks
+    def test_write_behind_delete(self):
+        m = TestModel2(name='Test')
+        yield m.save()
+        key = m.foo
+
+        Configuration.write_behind = True
+        try:
+            m.name = 'Changed'
+            yield m.save()
+            yield m.delete()
+            buffer = write_behind_buffer()
+            self.failUnlessEquals(len(buffer), 0)
+            yield buffer.drain()
+        finally:
+            Configuration.write_behind = False
+
+        i = yield TestModel2.get(key)
+        self.failUnlessEquals(i, None)
+
+    @inlineCallbacks
+    def test_write_behind_cache(self):
+        m = TestCachedModel(test2_id=self.test2_id, first_name='Jane', last_name='Schmidt', int_test=1)
+        yield m.save()
+
+        Configuration.write_behind = True
+        try:
+            m.int_test = 2
+            yield m.save()
+            # Read before the flush, which caches the row as it is stored
+            i = yield TestCachedModel.get(m.foo)
+            self.failUnlessEquals(i.int_test, 1)
+            yield write_behind_buffer().drain()
+        finally:
+            Configuration.write_behind = False
+
+        i = yield TestCachedModel.get(m.foo)
+        self.failUnlessEquals(i.int_test, 2)
+
+    @inlineCallbacks
+    def test_write_behind_retry(self):
+        failures = [TimedOutException()]
+        def batch_mutate(mutation_map):
+            if failures:
+                return defer.fail(failures.pop())
+            return Configuration.cassandra_client.batch_mutate(mutation_map)
+        client = type('FlakyClient', (object,), {'batch_mutate': staticmethod(batch_mutate)})()
+        clock = task.Clock()
+        buffer = WriteBehindBuffer(client, interval=1.0, clock=clock)
+
+        m = TestModel2(name='Test')
+        yield m.save()
+        m.name = 'Lost'
+        buffer.add(m._mutation_map_for_save())
+        try:
+            yield buffer.flush()
+            self.fail('flush should fail')
+        except TimedOutException:
+            pass
+        # The failed write is queued again, and a newer one replaces it
+        self.failUnlessEquals(len(buffer), 1)
+        m.name = 'Retried'
+        buffer.add(m._mutation_map_for_save())
+        clock.advance(1.0)
+        yield buffer.drain()
+        self.failUnlessEquals(len(buffer), 0)
+
+        i = yield TestModel2.get(m.foo)
+        self.failUnlessEquals(i.name, 'Retried')
+
+    @inlineCallbacks
+    def test_dirty_tracking(self):
+        i = yield TestModel1.get(self.test1_id)
+        i.first_name = i.first_name
+        i.json_test = {'a':1, 'b':[1,2,3]}
+        self.failUnlessEquals(i._mutation_map_for_save(), {})
+
+        i.int_test = 4
+        mutation_map = i._mutation_map_for_save()
+        self.failUnlessEquals(mutation_map[self.test1_id.bytes]['test1'].keys(), ['int_test'])
+        yield i.save()
+        i.int_test = 4
+        self.failUnlessEquals(i._mutation_map_for_save(), {})
+
+    def test_save_plan(self):
+        self.failUnlessEquals([a.name for a in TestModel1._pre_save_hooks], ['long_pin'])
+        self.failUnlessEquals(TestModel1._post_save_hooks, ())
+        self.failUnlessEquals(TestModel1._required_attributes, ('test2_id',))
+        self.failUnlessEquals(TestModel2._pre_save_hooks, ())
+
+    @inlineCallbacks
+    def test_column_slice(self):
+        row_key = uuid.uuid4()
+        ids = sorted([uuid.uuid1() for x in range(10)], key=lambda x: x.bytes)
+        for n, id in enumerate(ids):
+            yield TestColumnModel(test2_id=row_key, id=id, int_test=n).save()
+
+        rs = yield TestColumnModel.slice(row_key, start=ids[2], finish=ids[6])
+        self.failUnlessEquals([r.id for r in rs], ids[2:7])
+        rs = yield TestColumnModel.slice(row_key, start=ids[6], reversed=True, count=3)
+        self.failUnlessEquals([r.int_test for r in rs], [6, 5, 4])
+
+        seen = []
+        for page in TestColumnModel.iterate(row_key, page_size=3):
+            instances = yield page
+            self.failUnless(len(instances) <= 3)
+            seen.extend(instances)
+        self.failUnlessEquals([r.id for r in seen], ids)
+
+        q = TestColumnModel.filter(TestColumnModel.test2_id == row_key).filter(TestColumnModel.id > ids[7]).sort('-id')
+        rs = yield q.execute()
+        self.failUnlessEquals([r.int_test for r in rs], [9, 8])
+
+    @inlineCallbacks
+    def test_column_tags(self):
+        row_key = uuid.uuid4()
+        m = TestColumnModel(test2_id=row_key, id=uuid.uuid1(), int_test=1, long_test=1L)
+        yield m.save()
+
+        # Untagged columns are read, and moved to their tags on save
+        i = yield TestTaggedColumnModel.get(row_key, m.id)
+        self.failUnlessEquals((i.int_test, i.long_test), (1, 1L))
+        yield i.save()
+        columns = yield Configuration.cassandra_client.get_slice(row_key.bytes, 'col_test')
+        self.failUnlessEquals(sorted(c.column.name for c in columns), [m.id.bytes + '\x00\x01', m.id.bytes + '\x00\x02'])
+
+        rs = yield TestTaggedColumnModel.get(row_key)
+        self.failUnlessEquals([(r.id, r.int_test) for r in rs], [(m.id, 1)])
+
+    @inlineCallbacks
+    def test_packed_column_model(self):
+        row_key = uuid.uuid4()
+        ids = sorted([uuid.uuid1() for x in range(5)], key=lambda x: x.bytes)
+        for n, id in enumerate(ids):
+            yield TestPackedColumnModel(test2_id=row_key, id=id, int_test=n, long_test=long(n)).save()
+        columns = yield Configuration.cassandra_client.get_slice(row_key.bytes, 'col_test')
+        self.failUnlessEquals([c.column.name for c in columns], [id.bytes for id in ids])
+
+        i = yield TestPackedColumnModel.get(row_key, ids[1])
+        self.failUnlessEquals((i.int_test, i.long_test), (1, 1L))
+        i.int_test = 10
+        yield i.save()
+        rs = yield TestPackedColumnModel.slice(row_key, start=ids[1], count=2)
+        self.failUnlessEquals([(r.int_test, r.long_test) for r in rs], [(10, 1L), (2, 2L)])
+
+        # Values keep their positions when an attribute is added, wherever its name sorts
+        i = yield TestGrownPackedColumnModel.get(row_key, ids[2])
+        self.failUnlessEquals((i.char_test, i.int_test, i.long_test), (None, 2, 2L))
+        i.char_test = 'c'
+        yield i.save()
+        i = yield TestGrownPackedColumnModel.get(row_key, ids[2])
+        self.failUnlessEquals((i.char_test, i.int_test, i.long_test), ('c', 2, 2L))
+
+        # Saving an object that was not read keeps the stored attributes it does not set
+        yield TestPackedColumnModel(test2_id=row_key, id=ids[3], int_test=30).save()
+        i = yield TestPackedColumnModel.get(row_key, ids[3])
+        self.failUnlessEquals((i.int_test, i.long_test), (30, 3L))
+
+    @inlineCallbacks
+    def test_row_buckets(self):
+        source = uuid.uuid4()
+        start = time.time() - 3 * 3600
+        ids = [time_uuid(start + n * 1200, n) for n in range(9)]
+        for n, id in enumerate(ids):
+            yield TestSeriesModel(source=source, id=id, int_test=n).save()
+
+        i = yield TestSeriesModel.get(source, ids[4])
+        self.failUnlessEquals(i.int_test, 4)
+        rs = yield TestSeriesModel.slice(source, start=ids[1], finish=ids[7])
+        self.failUnlessEquals([r.int_test for r in rs], range(1, 8))
+        rs = yield TestSeriesModel.slice(source, start=ids[8], finish=ids[0], reversed=True, count=4)
+        self.failUnlessEquals([r.int_test for r in rs], [8, 7, 6, 5])
+
+    @inlineCallbacks
+    def test_column_delete(self):
+        row_key = uuid.uuid4()
+        ids = sorted([uuid.uuid1() for x in range(6)], key=lambda x: x.bytes)
+        for n, id in enumerate(ids):
+            yield TestColumnModel(test2_id=row_key, id=id, int_test=n).save()
+
+        i = yield TestColumnModel.get(row_key, ids[0])
+        r = yield i.delete()
+        self.failUnlessEquals(r, True)
+        i = yield TestColumnModel.get(row_key, ids[0])
+        self.failUnlessEquals(i, None)
+
+        # Cassandra 0.7 has no range deletions, so the columns are read and deleted by name
+        yield TestColumnModel.delete_range(row_key, ids[2], ids[3])
+        rs = yield TestColumnModel.get(row_key)
+        self.failUnlessEquals([r.int_test for r in rs], [1, 4, 5])
+        # With Configuration.range_deletions a SliceRange Deletion does it without reading; 0.7 would reject it
+        mutation_map = TestColumnModel._mutation_map_for_delete_range(row_key.bytes, TestColumnModel._pack_column_key(ids[4]), None)
+        self.failIfEquals(mutation_map[row_key.bytes]['col_test'][0].predicate.slice_range, None)
+
+        yield TestColumnModel.delete_range(row_key)
+        rs = yield TestColumnModel.get(row_key)
+        self.failUnlessEquals(rs, [])